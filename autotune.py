@@ -0,0 +1,151 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# autotune.py:  Sweeps the Canny, Hough and merge parameters of the
+#               setup phase across a process pool, scoring each set
+#               on the keyboard edges it finds in the reference image
+#
+#               Usage: python autotune.py [reference image] [--workers N]
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import argparse
+import itertools
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from calibration import CALIBRATION_LOCATION, load_setup_parameters, save_setup_parameters
+from fiducial import fiducial_markers
+from keyboard import (DEFAULT_SETUP_PARAMETERS, SetupParameters, contrast, keyboard_band, keyboard_edges,
+                      scale_setup_parameters, setup_scale)
+from merged_hough import hough_merged_image, merge_close
+from preview import ignore_interrupts
+
+# Candidate values of each parameter, lengths and distances in pixels of a SETUP_HEIGHT high image. The defaults come
+# first so they win ties
+CANNY_THRESHOLDS = [(80, 130), (40, 100), (60, 100), (60, 130), (80, 160), (100, 160), (100, 200), (120, 200),
+                    (30, 60)]
+HOUGH_THRESHOLDS = [9, 5, 15, 25]
+HOUGH_MIN_LENGTHS = [10, 30]
+HOUGH_MAX_GAPS = [35, 20, 60]
+HOUGH_MERGES = [10]
+MERGES = [(30, 1), (20, 1), (40, 2)]
+
+MAX_EDGE_ANGLE = 10  # degrees from horizontal at which an edge scores nothing
+MAX_EDGE_DIVERGENCE = 5  # degrees between the edges at which they score nothing
+MIN_EDGE_SEPARATION = 20  # pixels the keyboard edges must be apart, at SETUP_HEIGHT
+
+
+# score_edges: Scores the lines find_keyboard would take as the keyboard edges, from 0 to 1
+#              Two long, horizontal, parallel and separate edges score highest
+#              input: width - width of the reference image
+#              input: scale - setup_scale of the reference image
+def score_edges(ed, width, scale=1.0):
+    if len(ed) < 2:
+        return 0.0
+    angles = []
+    lengths = []
+    for (x0, y0), (x1, y1) in ed[0:2]:
+        angles.append(math.degrees(math.atan2(y1 - y0, x1 - x0)))
+        lengths.append(math.hypot(x1 - x0, y1 - y0))
+    separation = (ed[1][0][1] + ed[1][1][1] - ed[0][0][1] - ed[0][1][1]) / 2
+    if separation < MIN_EDGE_SEPARATION * scale:
+        return 0.0
+    horizontal = max(0.0, 1 - max(abs(angle) for angle in angles) / MAX_EDGE_ANGLE)
+    parallel = max(0.0, 1 - abs(angles[0] - angles[1]) / MAX_EDGE_DIVERGENCE)
+    return min(lengths) / width * horizontal * parallel
+
+
+# _sweep_canny: Runs in a worker process. Scores every Hough and merge candidate on the edges of one pair of Canny
+#               thresholds, so the contrast image is made once and the edges once per pair
+#               input: scale - setup_scale of the reference image, the candidates being scaled by it before use
+#               output: list of (score, SetupParameters), unscaled
+def _sweep_canny(img, band_top, top, bottom, width, scale, canny, hough_options, merge_options):
+    edges = cv2.Canny(img, threshold1=canny[0], threshold2=canny[1])
+    results = []
+    for hough in hough_options:
+        merged_lines_x = None
+        for merge in merge_options:
+            parameters = SetupParameters(*canny, *hough, *merge)
+            scaled = scale_setup_parameters(parameters, scale)
+            if merged_lines_x is None:
+                merged_lines_x = hough_merged_image(edges, scaled.hough_threshold, scaled.hough_min_length,
+                                                    scaled.hough_max_gap, scaled.hough_merge)
+            lines = [list(line) for line in merged_lines_x]
+            merge_close(lines, scaled.merge_distance, scaled.merge_angle)
+            score = score_edges(keyboard_edges(lines, band_top, top, bottom, scale), width, scale)
+            results.append((score, parameters))
+    return results
+
+
+# tune: Finds the setup parameters that score highest on an undistorted reference image of the empty keyboard
+#       input: workers - number of processes, or None for one per core this process may run on, such as a station's
+#                        pinned cores
+#       output: (parameters, score, results) - results being every (score, SetupParameters) best first
+def tune(reference, workers=None):
+    markers = fiducial_markers(reference)
+    if markers is None:
+        raise Exception("Could not find both fiducial markers")
+    top = int(markers[:, :, 1].min())
+    bottom = int(markers[:, :, 1].max())
+    scale = setup_scale(reference.shape[0])
+    band, band_top = keyboard_band(reference, markers)
+    img = contrast(band, scale)
+    width = reference.shape[1]
+
+    if workers is None:
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    hough_options = list(itertools.product(HOUGH_THRESHOLDS, HOUGH_MIN_LENGTHS, HOUGH_MAX_GAPS, HOUGH_MERGES))
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=ignore_interrupts) as pool:
+        futures = [pool.submit(_sweep_canny, img, band_top, top, bottom, width, scale, canny, hough_options, MERGES)
+                   for canny in CANNY_THRESHOLDS]
+        try:
+            for future in futures:
+                results += future.result()
+        except BaseException:
+            # Such as Ctrl+C during the setup phase, so the sweeps not started yet are not waited for
+            pool.shutdown(cancel_futures=True)
+            raise
+
+    # Stable sort, so the earlier candidate wins a tie
+    results.sort(key=lambda result: result[0], reverse=True)
+    score, parameters = results[0]
+    if score == 0:
+        return DEFAULT_SETUP_PARAMETERS, score, results
+    return parameters, score, results
+
+
+# tuned_parameters: The setup parameters saved with the camera calibration, or the defaults if none have been
+def tuned_parameters(location=CALIBRATION_LOCATION):
+    parameters = load_setup_parameters(location)
+    if parameters is None or len(parameters) != len(SetupParameters._fields):
+        return DEFAULT_SETUP_PARAMETERS
+    return SetupParameters(*parameters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the setup phase parameters for the lighting')
+    parser.add_argument('reference', nargs='?', default='predictions/original.jpg',
+                        help='undistorted reference image of the empty keyboard')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--calibration', default=CALIBRATION_LOCATION, help='calibration file to save them with')
+    args = parser.parse_args()
+
+    reference = cv2.imread(args.reference)
+    if reference is None:
+        raise FileNotFoundError("Could not read " + args.reference)
+    parameters, score, results = tune(reference, args.workers)
+    for candidate_score, candidate in results[:5]:
+        print('%.3f' % candidate_score, candidate)
+    if score == 0:
+        print('No candidate found the keyboard edges, leaving', args.calibration, 'unchanged')
+        return
+    print('Saving', parameters, 'with a score of %.3f to' % score, args.calibration)
+    save_setup_parameters(parameters, args.calibration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# benchmark.py:  Times every stage of the setup and real time phases
+#                on its own, on a synthetic keyboard image with
+#                fiducial markers, synthetic or recorded fingertip
+#                sets and a scripted MIDI stream. No camera, MIDI
+#                keyboard or display is needed. Hand inference is
+#                timed on recorded frames with hands when given
+#
+#                Usage: python benchmark.py [--output benchmark.json] [--compare old.json] [--frames sessions/lesson1]
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from fiducial import fiducial_markers
+from keyboard import contrast, key_index, keyboard_band
+from keys import MIDI_WHITE_KEYS, fingers_transform, raw_fingers_transform
+from merged_hough import hough_merged_image, merge_close
+from midi_events import ChordGrouper, MIDI_KEY_DOWN, note_ons
+from remap import apply_maps, build_maps
+from session import VIDEO_NAME
+
+WIDTH = 1920
+HEIGHT = 1080
+KEYBOARD_CORNERS = np.float32([(160, 500), (1760, 500), (1760, 760), (160, 760)])  # clockwise from the top left
+SEED = 0
+MAX_RECORDED_FRAMES = 30  # most recorded frames held in memory for timing hand inference, cycled through after that
+
+
+# synthetic_keyboard: Draws a 49-key keyboard between two ArUco fiducial markers on a dark background
+#                     output: (image, corners) - BGR image and the keyboard corners, clockwise from the top left
+def synthetic_keyboard(width=WIDTH, height=HEIGHT):
+    scale = np.float32([width / WIDTH, height / HEIGHT])
+    corners = KEYBOARD_CORNERS * scale
+    (left, top), (right, bottom) = corners[0], corners[2]
+    image = np.full((height, width, 3), 40, dtype=np.uint8)
+
+    # White keys with their borders, and the black keys over the top 60% of the keyboard
+    cv2.rectangle(image, (int(left), int(top)), (int(right), int(bottom)), (235, 235, 235), -1)
+    borders = np.linspace(left, right, num=30)
+    for x in borders[1:-1]:
+        cv2.line(image, (int(x), int(top)), (int(x), int(bottom)), (120, 120, 120), 2)
+    key_width = (right - left) / 29
+    for i in range(28):
+        if i % 7 not in (2, 6):
+            x = int(left + (i + 1) * key_width - key_width / 3)
+            cv2.rectangle(image, (x, int(top) + 12), (x + int(key_width * 2 / 3), int(top + (bottom - top) * 0.6)),
+                          (20, 20, 20), -1)
+
+    # Marker 0 starts above the keyboard on the left, marker 1 ends below it on the right, each on a white quiet zone
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_50)
+    size = int(100 * scale[1])
+    for marker_id, (x, y) in enumerate([(int(left) - size - 30, int(top) - 40),
+                                        (int(right) + 30, int(bottom) + 60 - size)]):
+        marker = cv2.aruco.generateImageMarker(dictionary, marker_id, size)
+        cv2.rectangle(image, (x - 10, y - 10), (x + size + 10, y + size + 10), (255, 255, 255), -1)
+        image[y:y + size, x:x + size] = marker[:, :, None]
+    return image, corners
+
+
+# synthetic_camera: Camera calibration with mild barrel distortion, for the undistort stages
+#                   output: (camera_matrix, distortion_coeff)
+def synthetic_camera(width=WIDTH, height=HEIGHT):
+    camera_matrix = np.array([[1.4 * width, 0, width / 2], [0, 1.4 * width, height / 2], [0, 0, 1]])
+    distortion_coeff = np.array([-0.1, 0.05, 0, 0, 0])
+    return camera_matrix, distortion_coeff
+
+
+# synthetic_fingers: Random sets of ten fingertips spread over the keyboard, in the undistorted image
+#                    output: (n, 10, 2) array of [x, y] points
+def synthetic_fingers(count, corners, rng):
+    (left, top), (right, bottom) = corners[0], corners[2]
+    x = rng.uniform(left - 20, right + 20, (count, 10))
+    y = rng.uniform(top - 40, bottom + 20, (count, 10))
+    return np.round(np.stack([x, y], axis=2)).astype(int)
+
+
+# scripted_midi: A MIDI stream of C major scales and triads played up and down the keyboard, as events returned by
+#                pygame's midi.Input.read
+def scripted_midi(count):
+    white = sorted(MIDI_WHITE_KEYS)
+    events = []
+    timestamp = 0
+    for i in range(count):
+        position = i % (2 * len(white) - 2)
+        root = white[position if position < len(white) else 2 * len(white) - 2 - position]
+        keys = [root] if i % 4 else [key for key in (root, root + 4, root + 7) if key <= white[-1]]
+        for key in keys:
+            events.append([[MIDI_KEY_DOWN, key, 90, 0], timestamp + len(events) % 3])
+        timestamp += 120
+        for key in keys:
+            events.append([[0x80, key, 0, 0], timestamp - 10])
+    return events
+
+
+# recorded_frames: Reads the first frames of a video, such as one recorded by piano.py with RECORD_LOCATION set
+#                  input: location - video file, or session folder holding one
+#                  output: list of count frames, the first MAX_RECORDED_FRAMES read cycled through
+def recorded_frames(location, count):
+    if os.path.isdir(location):
+        location = os.path.join(location, VIDEO_NAME)
+    cap = cv2.VideoCapture(location)
+    frames = []
+    while len(frames) < min(count, MAX_RECORDED_FRAMES):
+        success, image = cap.read()
+        if not success:
+            break
+        frames.append(image)
+    cap.release()
+    if not frames:
+        raise FileNotFoundError("Could not read frames from " + location)
+    return [frames[i % len(frames)] for i in range(count)]
+
+
+# measure: Calls run once per input, after warming it up, and returns the time of each call in ms
+def measure(run, inputs, warmup=2):
+    for value in inputs[:warmup]:
+        run(value)
+    times = []
+    for value in inputs:
+        start = time.perf_counter()
+        run(value)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+# summarise: Throughput and latency percentiles of a stage's call times
+def summarise(times):
+    times = np.array(times)
+    return {
+        'calls': len(times),
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'throughput_per_s': float(len(times) / (times.sum() / 1000)) if times.sum() > 0 else None,
+    }
+
+
+# run_benchmarks: Times every stage, returning {stage: summary} and {stage: reason} for the stages that were skipped
+#                 input: setup_repeat, frame_repeat - calls timed for each setup and each per-frame stage
+#                 input: landmarks - (n, 10, 2) fingertip sets to use instead of synthetic ones, or None
+#                 input: stages - names of the stages to run, or None for all of them
+#                 input: hand_frames - recorded frames with hands in them to time hand inference on, or None
+def run_benchmarks(setup_repeat=10, frame_repeat=200, landmarks=None, stages=None, hand_frames=None):
+    rng = np.random.default_rng(SEED)
+    reference, corners = synthetic_keyboard()
+    camera_matrix, distortion_coeff = synthetic_camera()
+    new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion_coeff, (WIDTH, HEIGHT), 1,
+                                                           (WIDTH, HEIGHT))
+    outs = np.float32([(0, 0), (WIDTH, 0), (WIDTH, HEIGHT), (0, HEIGHT)])
+    M = cv2.getPerspectiveTransform(corners, outs)
+    undistort_maps = build_maps(camera_matrix, distortion_coeff, new_camera_matrix, (WIDTH, HEIGHT))
+    warp_maps = build_maps(camera_matrix, distortion_coeff, new_camera_matrix, (WIDTH, HEIGHT), M)
+    index = key_index((WIDTH, HEIGHT))
+
+    if landmarks is None:
+        landmarks = synthetic_fingers(frame_repeat, corners, rng)
+    warped_landmarks = [fingers_transform(M, fingers) for fingers in landmarks]
+    events = scripted_midi(frame_repeat)
+    notes = [key for timestamp, key in note_ons(events) if key in index.notes]
+
+    # Setup stage inputs, each the output of the stage before it
+    markers = fiducial_markers(reference)
+    band, band_top = keyboard_band(reference, markers)
+    img = contrast(band)
+    edges = cv2.Canny(img, threshold1=80, threshold2=130)
+    merged_lines_x = hough_merged_image(edges, 9, 10, 35, 10)
+
+    setup = [reference] * setup_repeat
+    frames = [reference] * frame_repeat
+    benchmarks = {
+        'fiducial_markers': (lambda image: fiducial_markers(image), setup),
+        'contrast': (lambda image: contrast(band), setup),
+        'canny': (lambda image: cv2.Canny(img, threshold1=80, threshold2=130), setup),
+        'hough_merged_image': (lambda image: hough_merged_image(edges, 9, 10, 35, 10), setup),
+        'merge_close': (lambda image: merge_close([list(line) for line in merged_lines_x], 30, 1), setup),
+        'getPerspectiveTransform': (lambda image: cv2.getPerspectiveTransform(corners, outs), setup),
+        'undistort': (lambda image: apply_maps(image, undistort_maps), frames),
+        'undistort_unfused': (lambda image: cv2.undistort(image, camera_matrix, distortion_coeff, None,
+                                                          new_camera_matrix), frames),
+        'warp_remap': (lambda image: apply_maps(image, warp_maps), frames),
+        'warpPerspective': (lambda image: cv2.warpPerspective(image, M, (WIDTH, HEIGHT)), frames),
+        'fingers_transform': (lambda fingers: fingers_transform(M, fingers), list(landmarks)),
+        'raw_fingers_transform': (lambda fingers: raw_fingers_transform(M, fingers, camera_matrix, distortion_coeff,
+                                                                        new_camera_matrix), list(landmarks)),
+        'key_lookup': (lambda i: index.finger_on(notes[i % len(notes)], warped_landmarks[i % len(warped_landmarks)]),
+                       list(range(frame_repeat))),
+        'chord_grouping': (lambda i: chord_grouping(events), list(range(setup_repeat))),
+    }
+
+    # Without hands in the frame MediaPipe only runs palm detection, so the synthetic keyboard times the cheap case.
+    # The hand landmark model only runs on frames with hands, such as those of a recorded session
+    skipped = {}
+    try:
+        from fingers import HandTracker
+        empty_tracker = HandTracker(draw=False)
+        benchmarks['fingers_find_no_hands'] = (lambda image: empty_tracker.fingers_find(image, WIDTH, HEIGHT), frames)
+        if hand_frames is not None:
+            hand_tracker = HandTracker(draw=False)
+            benchmarks['fingers_find'] = (lambda image: hand_tracker.fingers_find(image, image.shape[1],
+                                                                                  image.shape[0]), hand_frames)
+        else:
+            skipped['fingers_find'] = 'no frames with hands, pass --frames with a recorded session'
+    except (ImportError, AttributeError) as e:
+        skipped['fingers_find_no_hands'] = skipped['fingers_find'] = 'MediaPipe Hands is not available: ' + str(e)
+
+    results = {}
+    for name, (run, inputs) in benchmarks.items():
+        if stages is None or name in stages:
+            results[name] = summarise(measure(run, inputs))
+    if stages is not None:
+        skipped = {name: reason for name, reason in skipped.items() if name in stages}
+    return results, skipped
+
+
+def chord_grouping(events):
+    chords = ChordGrouper(30)
+    chords.add(note_ons(events))
+    return chords.ready(events[-1][1] + 30)
+
+
+# compare: Prints how the p50 and p99 latency of each stage changed from an earlier results file
+def compare(old, new):
+    print('%-24s %10s %10s %8s %10s %10s %8s' % ('stage', 'old p50', 'new p50', 'ratio', 'old p99', 'new p99', 'ratio'))
+    for name, stage in new['stages'].items():
+        if name not in old['stages']:
+            continue
+        before = old['stages'][name]
+        print('%-24s %10.3f %10.3f %8.2f %10.3f %10.3f %8.2f' % (
+            name, before['p50_ms'], stage['p50_ms'], stage['p50_ms'] / max(before['p50_ms'], 1e-9),
+            before['p99_ms'], stage['p99_ms'], stage['p99_ms'] / max(before['p99_ms'], 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each stage of the piano fingering detector')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file the results are saved to')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--setup-repeat', type=int, default=10, help='calls timed for each setup stage')
+    parser.add_argument('--frame-repeat', type=int, default=200, help='calls timed for each per-frame stage')
+    parser.add_argument('--landmarks', help='.npy file of recorded (n, 10, 2) fingertip sets')
+    parser.add_argument('--stages', nargs='+', help='only run these stages')
+    parser.add_argument('--frames', help='session folder or video with hands over the keys, to time hand inference on')
+    args = parser.parse_args()
+
+    cv2.setRNGSeed(SEED)
+    landmarks = None if args.landmarks is None else np.load(args.landmarks).reshape(-1, 10, 2)
+    hand_frames = None if args.frames is None else recorded_frames(args.frames, args.frame_repeat)
+    stages, skipped = run_benchmarks(args.setup_repeat, args.frame_repeat, landmarks, args.stages, hand_frames)
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'python': sys.version.split()[0],
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'opencv_threads': cv2.getNumThreads(),
+        'stages': stages,
+        'skipped': skipped,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    print('%-24s %8s %10s %10s %10s %12s' % ('stage', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'calls/s'))
+    for name, stage in stages.items():
+        print('%-24s %8d %10.3f %10.3f %10.3f %12.1f' % (name, stage['calls'], stage['p50_ms'], stage['p95_ms'],
+                                                        stage['p99_ms'], stage['throughput_per_s'] or 0))
+    for name, reason in skipped.items():
+        print('%-24s skipped - %s' % (name, reason))
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == '__main__':
+    main()
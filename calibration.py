@@ -0,0 +1,191 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# calibration.py:  Camera calibration from chessboard views - finding
+#                  the board, keeping only distinct views, solving in
+#                  the background and saving the result to one file
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import threading
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+CALIBRATION_LOCATION = './camera_calibration.npz'
+CALIBRATION_VERSION = 1
+
+# Termination criteria for cornerSubPix
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+# Calibration: camera_matrix and distortion_coeff as given by calibrateCamera, the (width, height) of the frames they
+#              were found on and the RMS reprojection error in pixels
+Calibration = namedtuple('Calibration', ['camera_matrix', 'distortion_coeff', 'size', 'error'])
+
+
+# save_calibration: Saves a Calibration to one versioned binary file, keeping any setup parameters already saved in it
+def save_calibration(calibration, location=CALIBRATION_LOCATION):
+    extra = {}
+    setup_parameters = load_setup_parameters(location)
+    if setup_parameters is not None:
+        extra['setup_parameters'] = np.array(setup_parameters, dtype=float)
+    np.savez(location, version=CALIBRATION_VERSION, camera_matrix=calibration.camera_matrix,
+             distortion_coeff=calibration.distortion_coeff, size=np.array(calibration.size),
+             error=calibration.error, **extra)
+
+
+# load_calibration: Loads a Calibration saved by save_calibration
+#                   output: the Calibration, or None if there is no file or it was saved by a different version
+def load_calibration(location=CALIBRATION_LOCATION):
+    try:
+        with np.load(location) as data:
+            if int(data['version']) != CALIBRATION_VERSION:
+                return None
+            return Calibration(data['camera_matrix'], data['distortion_coeff'].ravel(),
+                               tuple(int(x) for x in data['size']), float(data['error']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# scale_calibration: Adapts a Calibration to frames captured at a different resolution with the same field of view,
+#                    such as 1280x720 from a camera calibrated at 1920x1080
+#                    output: the scaled Calibration, or None if the aspect ratio differs and it cannot be scaled
+def scale_calibration(calibration, size):
+    if tuple(size) == tuple(calibration.size):
+        return calibration
+    sx = size[0] / calibration.size[0]
+    sy = size[1] / calibration.size[1]
+    if abs(sx - sy) > 0.01:
+        return None
+    camera_matrix = calibration.camera_matrix.copy()
+    camera_matrix[0] *= sx
+    camera_matrix[1] *= sy
+    # The distortion coefficients are in normalised image coordinates, so they do not change
+    return Calibration(camera_matrix, calibration.distortion_coeff, tuple(size), calibration.error * sx)
+
+
+# save_setup_parameters: Adds the setup phase parameters tuned for the lighting to an existing calibration file
+#                        input: parameters - sequence of numbers, such as a keyboard.SetupParameters
+def save_setup_parameters(parameters, location=CALIBRATION_LOCATION):
+    with np.load(location) as data:
+        contents = dict(data)
+    contents['setup_parameters'] = np.array(parameters, dtype=float)
+    np.savez(location, **contents)
+
+
+# load_setup_parameters: Loads the setup phase parameters saved by save_setup_parameters
+#                        output: tuple of numbers, or None if none have been saved
+def load_setup_parameters(location=CALIBRATION_LOCATION):
+    try:
+        with np.load(location) as data:
+            if int(data['version']) != CALIBRATION_VERSION:
+                return None
+            return tuple(int(x) if x.is_integer() else x for x in data['setup_parameters'].tolist())
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# board_points: Corners of the chessboard in its own plane, like (0,0,0), (1,0,0), (2,0,0) ....,(8,5,0)
+def board_points(pattern):
+    columns, rows = pattern
+    objp = np.zeros((rows * columns, 3), np.float32)
+    objp[:, :2] = np.mgrid[0:columns, 0:rows].T.reshape(-1, 2)
+    return objp
+
+
+# find_chessboard: Finds the chessboard on a downscaled copy of the frame and refines the corners at full resolution
+#                  input: pattern - (columns, rows) of inner corners
+#                  input: detect_width - width the frame is downscaled to for finding the board
+#                  output: (n, 1, 2) float32 corners in the full resolution frame, or None if the board was not found
+def find_chessboard(gray, pattern, detect_width=640):
+    h, w = gray.shape[:2]
+    scale = min(detect_width / w, 1)
+    small = cv2.resize(gray, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    found, corners = cv2.findChessboardCorners(small, pattern, None, cv2.CALIB_CB_ADAPTIVE_THRESH
+                                               + cv2.CALIB_CB_NORMALIZE_IMAGE + cv2.CALIB_CB_FAST_CHECK)
+    if not found:
+        return None
+    corners = corners / scale
+    # The search window covers the error from finding the corners at the lower resolution
+    window = max(int(np.ceil(1 / scale)) * 2 + 1, 11)
+    return cv2.cornerSubPix(gray, corners, (window, window), (-1, -1), SUBPIX_CRITERIA)
+
+
+# ViewSet: The chessboard views kept for calibration, each differing from every other kept view
+#          input: min_distance - smallest mean movement in pixels of the corners for a view to count as new
+class ViewSet:
+    def __init__(self, min_distance=40):
+        self.min_distance = min_distance
+        self.views = []
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.views)
+
+    # add: Keeps the corners of a view unless a kept view is nearly the same
+    #      output: whether the view was kept
+    def add(self, corners):
+        corners = corners.reshape(-1, 2)
+        if self.views:
+            distances = np.linalg.norm(np.array(self.views) - corners, axis=2).mean(axis=1)
+            if distances.min() < self.min_distance:
+                self.rejected += 1
+                return False
+        self.views.append(corners)
+        return True
+
+
+# CalibrationSolver: Runs calibrateCamera on a background thread whenever views have been added since the last solve,
+#                    starting each solve from the last result
+#                    input: pattern - (columns, rows) of inner corners
+#                    input: size - (width, height) of the frames
+#                    input: min_views - views needed before the first solve
+class CalibrationSolver:
+    def __init__(self, pattern, size, min_views=5):
+        self.objp = board_points(pattern)
+        self.size = tuple(size)
+        self.min_views = min_views
+        self.views = []
+        self.result = None  # latest Calibration
+        self.solved_views = 0  # number of views the latest result was solved with
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='CalibrationSolver', daemon=True)
+        self.thread.start()
+
+    # add: Adds the corners of a new view
+    def add(self, corners):
+        with self.condition:
+            self.views.append(corners.reshape(-1, 1, 2).astype(np.float32))
+            self.condition.notify()
+
+    def _ready(self):
+        return not self.running or (len(self.views) >= self.min_views and len(self.views) != self.solved_views)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(self._ready)
+                if len(self.views) < self.min_views or len(self.views) == self.solved_views:
+                    return
+                views = list(self.views)
+                previous = self.result
+
+            flags = 0
+            camera_matrix, distortion_coeff = None, None
+            if previous is not None:
+                flags = cv2.CALIB_USE_INTRINSIC_GUESS
+                camera_matrix, distortion_coeff = previous.camera_matrix.copy(), previous.distortion_coeff.copy()
+            error, camera_matrix, distortion_coeff, rvecs, tvecs = cv2.calibrateCamera(
+                [self.objp] * len(views), views, self.size, camera_matrix, distortion_coeff, flags=flags)
+
+            with self.condition:
+                self.result = Calibration(camera_matrix, distortion_coeff.ravel(), self.size, error)
+                self.solved_views = len(views)
+                self.condition.notify_all()
+
+    # finish: Waits for a solve over every view added and returns its Calibration, or None if there are too few views
+    def finish(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        return self.result
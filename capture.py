@@ -0,0 +1,77 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# capture.py:  Background camera capture into a small ring buffer
+#              of timestamped frames, so the real time loop always
+#              takes the latest frame without waiting on the camera
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import threading
+import time
+from collections import deque, namedtuple
+
+# Frame: One captured frame, stamped with the clock passed to the FrameGrabber
+#        id counts up from 0 for every frame read from the camera
+Frame = namedtuple('Frame', ['timestamp', 'id', 'image'])
+
+
+# FrameGrabber: Reads frames from a camera on its own thread and keeps the most recent ones in a ring buffer
+#               input: cap - an opened cv2.VideoCapture
+#               input: clock - returns the current time in ms, on the same clock as the MIDI timestamps (midi.time)
+#               input: size - number of frames kept in the ring buffer. Only the latest is read, and each raw 1080p
+#                             frame holds about 6 MB
+#               input: sink - optional object whose put method is given every captured Frame, such as a recorder
+#               input: retry_delay - seconds to wait after a failed read, doubling up to max_retry_delay while reads
+#                                    keep failing, so a disconnected camera does not spin the thread
+class FrameGrabber:
+    def __init__(self, cap, clock, size=2, sink=None, retry_delay=0.01, max_retry_delay=0.5):
+        self.cap = cap
+        self.clock = clock
+        self.sink = sink
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.frames = deque(maxlen=size)
+        self.count = 0
+        self.failed_reads = 0
+        self.running = False
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='FrameGrabber', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        delay = self.retry_delay
+        while self.running:
+            success, image = self.cap.read()
+            timestamp = self.clock()
+            if not success:
+                self.failed_reads += 1
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+            frame = Frame(timestamp, self.count, image)
+            with self.condition:
+                self.frames.append(frame)
+                self.count += 1
+                self.condition.notify_all()
+            if self.sink is not None:
+                self.sink.put(frame)
+
+    # latest: Returns the most recent frame, waiting for one newer than after_id if given
+    #               input: after_id - id of the last frame the caller has seen, or None to accept any frame
+    #               input: timeout - seconds to wait before giving up and returning None
+    def latest(self, after_id=None, timeout=1.0):
+        with self.condition:
+            ready = self.condition.wait_for(
+                lambda: self.frames and (after_id is None or self.frames[-1].id > after_id), timeout)
+            if not ready:
+                return None
+            return self.frames[-1]
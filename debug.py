@@ -0,0 +1,43 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# debug.py:  Optional sink for the intermediate images of the
+#            setup phase, written to disk on a background thread
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import os
+import queue
+import threading
+
+import cv2
+
+
+# DebugSink: Writes named images into a directory on a background thread, so encoding never holds up the caller
+#            input: directory - folder to write into, or None to discard everything put into the sink
+class DebugSink:
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.queue = queue.Queue()
+        self.thread = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.thread = threading.Thread(target=self._run, name='DebugSink', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            name, img = item
+            cv2.imwrite(os.path.join(self.directory, name), img)
+
+    # put: Queues an image to be written. The image is not copied, so it must not be modified afterwards
+    def put(self, name, img):
+        if self.thread is not None:
+            self.queue.put((name, img))
+
+    # close: Waits for every queued image to be written
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
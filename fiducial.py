@@ -1,25 +1,33 @@
-# - - - - - - - - - - - - - - - - - - - - - - - - - 
-# fiducial.py:  Function to detect the fiducial marker and return
-#              the bottom right coordinate of the marker
-# - - - - - - - - - - - - - - - - - - - - - - - - - 
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# fiducial.py:  Functions to detect the two fiducial markers and
+#              return their corners
+# - - - - - - - - - - - - - - - - - - - - - - - - -
 
 import cv2
+import numpy as np
 
+_detector = None
 
-# fiducial_detect: Detects the fiducial marker and returns the bottom right coordinate of the marker
-def fiducial_detect(image):
+
+# aruco_detector: Creates an ArucoDetector for the fiducial markers
+def aruco_detector():
     arucoDict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_50)
     arucoParams = cv2.aruco.DetectorParameters()
-    arucoDetector = cv2.aruco.ArucoDetector(arucoDict, arucoParams)
-    (corners, ids, rejected) = arucoDetector.detectMarkers(image)
+    return cv2.aruco.ArucoDetector(arucoDict, arucoParams)
 
-    if len(corners) != 2:
-        print(corners)
-        raise Exception
 
-    corners = [corner for marker in corners for corner in marker[0]]
+# fiducial_markers: Detects the two fiducial markers and returns their corners, ordered by marker id
+#                   input: detector - ArucoDetector to use, or None for one shared detector created on first use
+#                   output: (2, 4, 2) array of marker corners, or None if there are not exactly two markers
+def fiducial_markers(image, detector=None):
+    global _detector
+    if detector is None:
+        if _detector is None:
+            _detector = aruco_detector()
+        detector = _detector
+    (corners, ids, rejected) = detector.detectMarkers(image)
 
-    min_y = int(min(corner[1] for corner in corners))
-    max_y = int(max(corner[1] for corner in corners))
+    if len(corners) != 2:
+        return None
 
-    return min_y, max_y
+    return np.array([corners[i][0] for i in np.argsort(ids.ravel(), kind='stable')])
@@ -0,0 +1,152 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# fiducial_monitor.py:  Low rate tracking of the fiducial markers
+#                       during the real time phase, correcting the
+#                       keyboard homography when the keyboard moves
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import math
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from fiducial import aruco_detector, fiducial_markers
+from keyboard import setup_scale
+
+
+# FiducialMonitor: Finds the fiducial markers in raw camera frames on a background thread and keeps a keyboard
+#                  model corrected for small movements of the keyboard
+#                  input: keyboard - Keyboard from the setup phase
+#                  input: camera_matrix, distortion_coeff, new_camera_matrix - camera calibration, used to undistort
+#                                                                              the marker corners
+#                  input: scale - factor frames are downscaled by before detection
+#                  input: tolerance - marker movement that is ignored as detection noise
+#                  input: recalibrate_distance - marker movement too large to correct, which instead sets
+#                                                needs_recalibration
+#                  Both are in pixels of a SETUP_HEIGHT high image, and scaled to the keyboard's image size
+#                  input: retry_delay - seconds before a failed recalibration is tried again, doubling up to
+#                                       max_retry_delay while it keeps failing
+class FiducialMonitor:
+    def __init__(self, keyboard, camera_matrix, distortion_coeff, new_camera_matrix, scale=0.5, tolerance=2,
+                 recalibrate_distance=40, retry_delay=5, max_retry_delay=60):
+        self.keyboard = keyboard
+        self.camera_matrix = camera_matrix
+        self.distortion_coeff = distortion_coeff
+        self.new_camera_matrix = new_camera_matrix
+        self.scale = scale
+        self.tolerance = tolerance
+        self.recalibrate_distance = recalibrate_distance
+        self.first_retry_delay = retry_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.detector = aruco_detector()
+        self.version = 0  # incremented every time keyboard is replaced
+        self.needs_recalibration = False
+        self.missed = 0  # checks where the markers were not found
+        self.recalibration = None  # thread running the last recalibration
+        self.recalibrating = False
+        self.retry_at = -math.inf  # time.monotonic before which no recalibration is started
+        self.reference = None  # raw frame the last recalibration found the keyboard on, until taken
+        self.frames = queue.Queue(maxsize=1)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='FiducialMonitor', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.frames.put(None)
+        self.thread.join()
+        if self.recalibration is not None:
+            self.recalibration.join()
+
+    # submit: Hands a raw frame to the monitor, dropping it if the monitor is still busy with the previous one
+    def submit(self, image):
+        try:
+            self.frames.put_nowait(image)
+        except queue.Full:
+            pass
+
+    # current: Returns (version, keyboard) for the latest keyboard model
+    def current(self):
+        with self.lock:
+            return self.version, self.keyboard
+
+    # recalibrate: Finds the keyboard again on a background thread once it has moved too far to be corrected. Does
+    #              nothing while a recalibration is running, or before the retry delay after a failed one has passed
+    #              input: image - raw frame with no hands over the keys
+    #              input: setup - function finding the Keyboard in a raw frame, raising an exception if it cannot
+    #              input: args - further arguments of setup
+    #              output: whether a recalibration was started
+    def recalibrate(self, image, setup, *args):
+        with self.lock:
+            if self.recalibrating or time.monotonic() < self.retry_at:
+                return False
+            self.recalibrating = True
+        self.recalibration = threading.Thread(target=self._recalibrate, args=(image, setup, args),
+                                              name='Recalibration', daemon=True)
+        self.recalibration.start()
+        return True
+
+    def _recalibrate(self, image, setup, args):
+        try:
+            keyboard = setup(image, *args)
+        except Exception as e:
+            print('Setup failed, keep hands clear of the keyboard:', e)
+            keyboard = None
+        with self.lock:
+            self.recalibrating = False
+            if keyboard is None:
+                self.retry_at = time.monotonic() + self.retry_delay
+                self.retry_delay = min(2 * self.retry_delay, self.max_retry_delay)
+                return
+            self.keyboard = keyboard
+            self.version += 1
+            self.reference = image
+            self.needs_recalibration = False
+            self.retry_delay = self.first_retry_delay
+
+    # take_reference: Returns the raw frame the last recalibration found the keyboard on, once, or None
+    def take_reference(self):
+        with self.lock:
+            reference, self.reference = self.reference, None
+            return reference
+
+    def _run(self):
+        while True:
+            image = self.frames.get()
+            if image is None:
+                return
+            self._check(image)
+
+    def _check(self, image):
+        small = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        markers = fiducial_markers(small, self.detector)
+        if markers is None:
+            self.missed += 1
+            return
+
+        # Back to full resolution, then into the undistorted image the keyboard model lives in
+        markers = (markers + 0.5) / self.scale - 0.5
+        markers = cv2.undistortPoints(markers.reshape(-1, 1, 2).astype(np.float32), self.camera_matrix,
+                                      self.distortion_coeff, P=self.new_camera_matrix).reshape(markers.shape)
+
+        keyboard = self.keyboard
+        movement = np.abs(markers - keyboard.markers).max() / setup_scale(keyboard.size[1])
+        if movement <= self.tolerance:
+            return
+        if movement > self.recalibrate_distance:
+            with self.lock:
+                if self.keyboard is keyboard:
+                    self.needs_recalibration = True
+            return
+
+        corrected = keyboard.corrected(markers)
+        with self.lock:
+            # Skip the correction if the keyboard was replaced while it was being worked out
+            if corrected is not None and self.keyboard is keyboard:
+                self.keyboard = corrected
+                self.version += 1
@@ -1,56 +1,63 @@
 # find_camera_calibration.py
 
-import numpy as np
 import cv2
 
+from calibration import CALIBRATION_LOCATION, CalibrationSolver, ViewSet, find_chessboard, save_calibration
+
 CHECKERBOARD_ROW = 6
 CHECKERBOARD_COL = 9
+CAPTURE_SIZE = (1920, 1080)  # (width, height) to calibrate at, piano.py scales it to other sizes of the same shape
+DETECT_WIDTH = 640  # width frames are downscaled to when looking for the chessboard
+MIN_VIEW_DISTANCE = 40  # mean corner movement in pixels for a view to be different enough to keep
 
-# Termination criteria for cornerSubPix
-criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-
-# Prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-objp = np.zeros((CHECKERBOARD_ROW*CHECKERBOARD_COL,3), np.float32)
-objp[:,:2] = np.mgrid[0:CHECKERBOARD_COL,0:CHECKERBOARD_ROW].T.reshape(-1,2)
-
-# Arrays to store object points and image points from all the images.
-objpoints = [] # 3d point in real world space.
-imgpoints = [] # 2d points in image plane.
 
-cap = cv2.VideoCapture(0)
-cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
+def main():
+    pattern = (CHECKERBOARD_COL, CHECKERBOARD_ROW)
+    cap = cv2.VideoCapture(0)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_SIZE[0])
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_SIZE[1])
 
-while cv2.waitKey(1) < 0:
     ret, frame = cap.read()
-    print(ret)
-    print(frame)
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-    ret, corners = cv2.findChessboardCorners(gray, (CHECKERBOARD_COL,CHECKERBOARD_ROW), None)  # Find the chess board corners.
-
-    # If found, add object points, image points (after refining them).
-    if ret == True:
-        objpoints.append(objp)
-
-        refined_corners = cv2.cornerSubPix(gray, corners, (11,11), (-1,-1), criteria)
-        imgpoints.append(refined_corners)
-
-        # Draw and display the corners.
-        frame = cv2.drawChessboardCorners(frame, (CHECKERBOARD_COL,CHECKERBOARD_ROW), refined_corners, ret)
-        cv2.imshow('Camera Calibration', frame)
-        # Delay for half a second so we don't end up with a massive number of points to process later.
-        cv2.waitKey(500)
-    else:
-        cv2.imshow('Camera Calibration', frame)
-
-print("Calculating Camera Distortion...")
-print("Depending on how many frames were captured, this may take some time...")
-ret, camera_matrix, distortion_coeff, rvec, tvec = cv2.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
-
-# Save the camera matrix and distortion coefficients for later.
-np.savetxt('camera_matrix.npy', camera_matrix)
-np.savetxt('distortion_coeff.npy', distortion_coeff)
-
-cap.release()
-cv2.destroyAllWindows()
+    if not ret:
+        cap.release()
+        print("Could not read a frame from camera 0, check that it is connected and not in use")
+        return
+    h, w = frame.shape[:2]
+    views = ViewSet(MIN_VIEW_DISTANCE)
+    solver = CalibrationSolver(pattern, (w, h))
+
+    while cv2.waitKey(1) < 0:
+        ret, frame = cap.read()
+        if not ret:
+            continue
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        # If found and different from the views already kept, add it to the solve running in the background
+        corners = find_chessboard(gray, pattern, DETECT_WIDTH)
+        if corners is not None:
+            if views.add(corners):
+                solver.add(corners)
+            frame = cv2.drawChessboardCorners(frame, pattern, corners, True)
+
+        result = solver.result
+        status = '%d views, %d near duplicates skipped' % (len(views), views.rejected)
+        if result is not None:
+            status += ', reprojection error %.3f px over %d views' % (result.error, solver.solved_views)
+        cv2.putText(frame, status, (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        cv2.imshow('Camera Calibration', cv2.resize(frame, (960, 540)))
+
+    print("Finishing the camera calibration over", len(views), "views...")
+    calibration = solver.finish()
+    cap.release()
+    cv2.destroyAllWindows()
+    if calibration is None:
+        print("Not enough chessboard views to calibrate the camera, at least", solver.min_views, "are needed")
+        return
+
+    # Save the camera matrix and distortion coefficients for later.
+    save_calibration(calibration, CALIBRATION_LOCATION)
+    print("Saved", CALIBRATION_LOCATION, "with a reprojection error of %.3f px" % calibration.error)
+
+
+if __name__ == '__main__':
+    main()
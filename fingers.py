@@ -3,71 +3,163 @@
 #              to determine what key has been pressed from these
 # - - - - - - - - - - - - - - - - - - - - - - - - - 
 
+from collections import OrderedDict, namedtuple
+
 import cv2
-import mediapipe as mp
 import numpy as np
 import math
 
+from metrics import NullMetrics
+
+# Landmarks: The hands found in one frame
+#            points - (hands, 21, 3) float32 MediaPipe landmarks, x and y normalised to the whole frame
+#            handedness - (hands,) int8 index into HANDEDNESS of the label MediaPipe gave each hand
+Landmarks = namedtuple('Landmarks', ['points', 'handedness'])
+HANDEDNESS = ('Left', 'Right')
+NO_HANDS = Landmarks(np.zeros((0, 21, 3), dtype=np.float32), np.zeros(0, dtype=np.int8))
+
+LEFT_HAND_TIPS = [20, 16, 12, 8, 4]  # landmark ids of the fingertips, from the pinky of the left hand
+RIGHT_HAND_TIPS = [4, 8, 12, 16, 20]  # landmark ids of the fingertips, from the thumb of the right hand
+HAND_CHAINS = [(0, 1, 2, 3, 4), (0, 5, 6, 7, 8), (9, 10, 11, 12), (13, 14, 15, 16), (0, 17, 18, 19, 20),
+               (5, 9, 13, 17)]  # landmark ids joined by the lines of the drawn hand
+
+
+# LandmarkCache: The Landmarks of the last few frames inferred, by frame id, dropping the least recently used
+class LandmarkCache:
+    def __init__(self, size=8):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, frame_id):
+        if frame_id is None or frame_id not in self.entries:
+            return None
+        self.entries.move_to_end(frame_id)
+        return self.entries[frame_id]
+
+    def put(self, frame_id, landmarks):
+        if frame_id is None:
+            return
+        self.entries[frame_id] = landmarks
+        self.entries.move_to_end(frame_id)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    # latest: The Landmarks of the frame with the highest id, or None if the cache is empty
+    def latest(self):
+        if not self.entries:
+            return None
+        return self.entries[max(self.entries)]
+
 
 # HandTracker: HandTracker class from MediaPipe Hands
 #              Sourced online from: https://google.github.io/mediapipe/solutions/hands.html        
+#              input: band - (top, bottom) rows of the frame to run inference on, or None for the whole frame
+#              input: inputWidth - width the band is downscaled to before inference, or None to keep it as is
+#              input: draw - whether find_hands draws the landmarks onto the frame by default
+#              input: metrics - Metrics or Timings the stages of inference are timed into, or None to not time them
 class HandTracker:
-    def __init__(self, mode=False, maxHands=2, modelComplexity=1, detectionCon=0.5, trackCon=0.5):
+    def __init__(self, mode=False, maxHands=2, modelComplexity=1, detectionCon=0.5, trackCon=0.5, band=None,
+                 inputWidth=None, draw=True, metrics=None):
+        # MediaPipe is only imported by the processes that run inference, as it is slow to load
+        import mediapipe as mp
+
         self.mpHands = mp.solutions.hands
+        self.options = (mode, maxHands, detectionCon, trackCon)
+        self.modelComplexity = modelComplexity
         self.hands = self.mpHands.Hands(mode, maxHands, modelComplexity, detectionCon, trackCon)
         self.mpDraw = mp.solutions.drawing_utils
+        self.band = band
+        self.inputWidth = inputWidth
+        self.draw = draw
+        self.metrics = NullMetrics() if metrics is None else metrics
+        self.bandTop = 0.0  # top of the processed band, as a fraction of the frame height
+        self.bandHeight = 1.0  # height of the processed band, as a fraction of the frame height
+
+    # configure: Changes the model complexity and input width of a running tracker, rebuilding the MediaPipe graph when
+    #            the model complexity changes
+    def configure(self, modelComplexity, inputWidth):
+        self.inputWidth = inputWidth
+        if modelComplexity != self.modelComplexity:
+            mode, maxHands, detectionCon, trackCon = self.options
+            self.hands.close()
+            self.hands = self.mpHands.Hands(mode, maxHands, modelComplexity, detectionCon, trackCon)
+            self.modelComplexity = modelComplexity
 
-    def find_hands(self, img, draw=True):
-        imgRGB = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def find_hands(self, img, draw=None):
+        if draw is None:
+            draw = self.draw
+
+        t = self.metrics.clock()
+        h, w = img.shape[:2]
+        top, bottom = (0, h) if self.band is None else (max(int(self.band[0]), 0), min(int(self.band[1]), h))
+        self.bandTop = top / h
+        self.bandHeight = (bottom - top) / h
+
+        # The band spans the full width, so it is a view into img and landmarks drawn onto it land on img
+        band = img[top:bottom]
+        small = band
+        if self.inputWidth is not None and self.inputWidth < w:
+            scale = self.inputWidth / w
+            small = cv2.resize(band, (self.inputWidth, max(round((bottom - top) * scale), 1)),
+                               interpolation=cv2.INTER_AREA)
+
+        imgRGB = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        t = self.metrics.since('hand_resize', t)
         self.results = self.hands.process(imgRGB)
+        t = self.metrics.since('mediapipe', t)
 
         if self.results.multi_hand_landmarks:
             for handLms in self.results.multi_hand_landmarks:
                 if draw:
-                    self.mpDraw.draw_landmarks(img, handLms, self.mpHands.HAND_CONNECTIONS)
+                    self.mpDraw.draw_landmarks(band, handLms, self.mpHands.HAND_CONNECTIONS)
+            self.metrics.since('hand_draw', t)
 
-    def find_key_points(self, img):
-        leftHand = []
-        rightHand = []
-        handTypes = []
+    # landmarks: Runs inference on a frame
+    #            output: Landmarks of the hands found
+    def landmarks(self, img):
+        self.find_hands(img)
+        t = self.metrics.clock()
+        landmarks = self._landmark_array()
+        self.metrics.since('landmarks', t)
+        return landmarks
 
-        if self.results.multi_hand_landmarks:
-            for hand in self.results.multi_handedness:
-                handType = hand.classification[0].label
-                handTypes.append(handType)
-
-            for index, handLms in enumerate(self.results.multi_hand_landmarks):
-                for id, lm in enumerate(handLms.landmark):
-                    h, w, c = img.shape
-                    cx, cy = int(lm.x * w), int(lm.y * h)
-                    if handTypes[index] == "Right":
-                        # leftHand.append([id, cx, cy])
-                        leftHand.append([id, lm.x, lm.y])
-                    else:
-                        # rightHand.append([id, cx, cy])
-                        rightHand.append([id, lm.x, lm.y])
-
-        return leftHand, rightHand
+    # _landmark_array: Converts the results of find_hands into Landmarks, with the landmarks normalised to the processed
+    #                  band mapped back to the whole frame
+    def _landmark_array(self):
+        if not self.results.multi_hand_landmarks:
+            return NO_HANDS
+        points = np.array([[(lm.x, lm.y, lm.z) for lm in handLms.landmark]
+                           for handLms in self.results.multi_hand_landmarks], dtype=np.float32)
+        points[:, :, 1] = self.bandTop + points[:, :, 1] * self.bandHeight
+        handedness = np.array([HANDEDNESS.index(hand.classification[0].label)
+                               for hand in self.results.multi_handedness], dtype=np.int8)
+        return Landmarks(points, handedness)
 
     # fingers_find: Determines and returns the location of the left and right index fingers from the current video frame
     #                       input: img - current image from the video frame
     #                       input: width - width of the image
     #                       input: height - height of the image
     def fingers_find(self, img, width, height):
-        self.find_hands(img)
-        leftHand, rightHand = self.find_key_points(img)
-        left_hand_locations = [20, 16, 12, 8, 4]
-        right_hand_locations = [4, 8, 12, 16, 20]
-        fingers = [[0, 0]] * 10
-
-        # Find the coordinate of the left index finger
-        if len(leftHand) != 0:
-            for i, location in enumerate(left_hand_locations):
-                fingers[i] = [(round(leftHand[location][1] * width)), (round(leftHand[location][2] * height))]
-
-        # Find the coordinate of the right index finger
-        if len(rightHand) != 0:
-            for i, location in enumerate(right_hand_locations):
-                fingers[5 + i] = [(round(rightHand[location][1] * width)), (round(rightHand[location][2] * height))]
-
-        return fingers
+        return fingertips(self.landmarks(img), width, height)
+
+
+# fingertips: The fingertips of the first hand of each side in Landmarks, left pinky to right pinky
+#             output: (10, 2) int32 array of pixel coordinates, [0, 0] for the fingertips of a hand that was not found
+def fingertips(landmarks, width, height):
+    fingers = np.zeros((10, 2), dtype=np.int32)
+    points, handedness = landmarks
+    # The camera faces the player, so MediaPipe's right hand is the player's left
+    for first, label, tips in ((0, 'Right', LEFT_HAND_TIPS), (5, 'Left', RIGHT_HAND_TIPS)):
+        hands = np.flatnonzero(handedness == HANDEDNESS.index(label))
+        if len(hands):
+            fingers[first:first + 5] = np.round(points[hands[0], tips, :2] * (width, height))
+    return fingers
+
+
+# draw_landmarks: Draws the hand skeletons of Landmarks onto an image of the frame they were found in
+def draw_landmarks(img, landmarks, color=(0, 255, 0)):
+    h, w = img.shape[:2]
+    for hand in landmarks.points:
+        pixels = np.round(hand[:, :2] * (w, h)).astype(np.int32)
+        cv2.polylines(img, [pixels[list(chain)] for chain in HAND_CHAINS], False, color, 2)
+    return img
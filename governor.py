@@ -0,0 +1,111 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# governor.py:  Keeps the delay of hand inference within a budget by
+#               stepping it down to cheaper settings under load, and
+#               back up once it has passed
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+from collections import namedtuple
+
+import numpy as np
+
+# Level: Settings of hand inference, from the most accurate level to the cheapest
+#        model_complexity - MediaPipe Hands model complexity, 0 or 1
+#        inference_interval - ms between hand inferences
+#        input_width - width the band around the keyboard is downscaled to before inference, None for full resolution
+Level = namedtuple('Level', ['model_complexity', 'inference_interval', 'input_width'])
+
+
+# LatencyGovernor: Moves between levels once every window, one level at a time
+#                  Judges each level on the delay from a frame's capture to its landmarks reaching the fingertip
+#                  tracker, the inference round trip plus any backlog. Unlike the latency from key press to decision,
+#                  it does not grow with the ms between inferences, so the slower levels can recover
+#                  Steps down a level after a window whose 90th percentile delay was over budget or whose frames
+#                  awaiting inference reached max_queue. Steps back up after recover_windows windows in a row under
+#                  recover_fraction of the budget with the queue below max_queue. The first window, holding frames
+#                  queued during warm-up, and windows of fewer than min_samples delays are not judged
+#                  input: levels - list of Level, most accurate first
+#                  input: budget - ms of delay to stay within
+#                  input: min_samples - fewest delays a window is judged on
+#                  input: window - ms of measurements each decision is made on
+#                  input: hold - ms after a switch before the next one, so the effect of a switch is measured
+#                                before it is judged, including MediaPipe rebuilding its graph
+class LatencyGovernor:
+    def __init__(self, levels, budget=70, window=2000, max_queue=2, recover_fraction=0.75, recover_windows=3,
+                 hold=5000, min_samples=10):
+        self.levels = levels
+        self.budget = budget
+        self.window = window
+        self.max_queue = max_queue
+        self.recover_fraction = recover_fraction
+        self.recover_windows = recover_windows
+        self.hold = hold
+        self.min_samples = min_samples
+
+        self.index = 0
+        self.switches = 0
+        self.level_time = [0.0] * len(levels)  # ms spent at each level
+        self.delays = []
+        self.queue = 0  # most frames awaiting inference in the window
+        self.under = 0  # windows in a row under the recovery threshold
+        self.window_start = None
+        self.judged = False  # whether a window has been judged yet, the first never is
+        self.switched_at = None
+        self.last_update = None
+        self.last_reason = None  # measurements that caused the last switch
+
+    @property
+    def level(self):
+        return self.levels[self.index]
+
+    # observe: Adds the delay in ms from a frame's capture to its landmarks reaching the fingertip tracker
+    def observe(self, delay):
+        self.delays.append(delay)
+
+    # update: Adds the number of frames awaiting inference, and ends the window when it is due
+    #         input: now - current time in ms
+    #         output: the new Level if the governor switched, otherwise None
+    def update(self, now, queue):
+        if self.window_start is None:
+            self.window_start = self.last_update = now
+        self.level_time[self.index] += now - self.last_update
+        self.last_update = now
+        self.queue = max(self.queue, queue)
+        if now - self.window_start < self.window:
+            return None
+
+        samples = len(self.delays)
+        p90 = float(np.percentile(self.delays, 90)) if samples else None
+        queued = self.queue
+        self.delays = []
+        self.queue = 0
+        self.window_start = now
+        first, self.judged = not self.judged, True
+        if first or samples < self.min_samples:
+            return None
+        if self.switched_at is not None and now - self.switched_at < self.hold:
+            return None
+
+        over = p90 > self.budget or queued >= self.max_queue
+        under = p90 < self.budget * self.recover_fraction and queued < self.max_queue
+        self.under = self.under + 1 if under else 0
+        if over and self.index < len(self.levels) - 1:
+            step = 1
+        elif self.under >= self.recover_windows and self.index > 0:
+            step = -1
+        else:
+            return None
+
+        self.index += step
+        self.switches += 1
+        self.under = 0
+        self.switched_at = now
+        self.last_reason = 'p90 inference delay %.0f ms over %d frames, %d frames awaiting inference' % (
+            p90, samples, queued)
+        return self.level
+
+    # gauges: Sets the current level, the number of switches and the seconds spent at each level in Metrics
+    def gauges(self, metrics):
+        metrics.set('governor_level', self.index)
+        metrics.set('governor_switches', self.switches)
+        for i, ms in enumerate(self.level_time):
+            metrics.set('governor_level_%d_seconds' % i, '%.1f' % (ms / 1000))
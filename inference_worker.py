@@ -0,0 +1,213 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# inference_worker.py:  Hand inference in a separate process, fed
+#                       frames through a shared memory ring and
+#                       returning hand landmarks tagged with frame ids
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import multiprocessing
+import queue
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from metrics import NullMetrics, Timings
+from preview import ignore_interrupts
+
+
+# SharedFrameRing: A ring of equally sized frames in shared memory
+#                  input: shape - shape of every frame, such as (1080, 1920, 3)
+#                  input: slots - number of frames in the ring
+#                  input: name - name of an existing ring to attach to, or None to create a new one
+class SharedFrameRing:
+    def __init__(self, shape, slots, name=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        size = int(np.prod(self.shape)) * slots
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self, unlink=False):
+        self.frames = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+# warm_up: Builds a HandTracker and runs one inference on a blank frame, so the first real frame does not pay for
+#          loading MediaPipe and initialising its graph
+#          input: shape - shape of the frames inference will run on
+#          input: metrics - Metrics or Timings for the HandTracker to time inference into after the warm-up, or None
+def warm_up(shape, metrics=None, **tracker_args):
+    from fingers import HandTracker
+
+    hand_tracker = HandTracker(**tracker_args)
+    hand_tracker.landmarks(np.zeros(shape, dtype=np.uint8))
+    if metrics is not None:
+        hand_tracker.metrics = metrics
+    return hand_tracker
+
+
+# _worker: Runs in the worker process. Takes ('frame', (frame_id, slot)), ('band', band) and
+#          ('configure', (modelComplexity, inputWidth)) requests until None arrives
+#          input: ready - Event set once the worker has warmed up
+#          input: timed - whether to send the HandTracker's stage timings back with each result
+def _worker(ring_name, shape, slots, requests, results, ready, tracker_args, timed):
+    ignore_interrupts()
+    ring = SharedFrameRing(shape, slots, ring_name)
+    hand_tracker = warm_up(shape, Timings() if timed else None, **tracker_args)
+    ready.set()
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        kind, value = request
+        if kind == 'band':
+            hand_tracker.band = value
+        elif kind == 'configure':
+            hand_tracker.configure(*value)
+        else:
+            frame_id, slot = value
+            landmarks = hand_tracker.landmarks(ring.frames[slot])
+            results.put((frame_id, landmarks, hand_tracker.metrics.drain()))
+    ring.close()
+
+
+# InferenceWorker: Runs hand inference in separate processes on frames published into a shared memory ring
+#                  input: shape - shape of the undistorted frames
+#                  input: slots - frames in the ring, the most frames that can wait for inference at once
+#                  input: workers - number of worker processes, each with its own HandTracker. Each frame goes to the
+#                                   worker with the fewest frames waiting
+#                  input: metrics - Metrics to record the workers' stage timings and round trip times in, or None
+#                  input: tracker_args - keyword arguments for the workers' HandTrackers
+#                  The workers load MediaPipe and warm up as soon as they are started, so they can be started before
+#                  the setup phase and the band set once the keyboard is found
+class InferenceWorker:
+    def __init__(self, shape, slots=4, workers=1, metrics=None, **tracker_args):
+        context = multiprocessing.get_context('spawn')
+        self.metrics = NullMetrics() if metrics is None else metrics
+        self.ring = SharedFrameRing(shape, slots)
+        self.requests = [context.Queue() for _ in range(workers)]
+        self.results = context.Queue()
+        self.ready_events = [context.Event() for _ in range(workers)]
+        self.free = list(range(slots))
+        self.slot_of = {}  # ring slot of every frame id waiting for inference
+        self.worker_of = {}  # worker of every frame id waiting for inference
+        self.queued = [0] * workers  # frames waiting for inference on each worker
+        self.published = {}  # clock when every frame id waiting for inference was published
+        self.processes = [context.Process(target=_worker, name='InferenceWorker-%d' % i, daemon=True,
+                                          args=(self.ring.name, self.ring.shape, slots, requests, self.results,
+                                                ready, tracker_args, self.metrics.enabled))
+                          for i, (requests, ready) in enumerate(zip(self.requests, self.ready_events))]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    # ready: Whether every worker has warmed up. Frames published before then wait for it
+    def ready(self):
+        return all(event.is_set() for event in self.ready_events)
+
+    def stop(self):
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join()
+        self.ring.close(unlink=True)
+
+    # set_band: Changes the band of rows the workers' HandTrackers run inference on
+    def set_band(self, band):
+        for requests in self.requests:
+            requests.put(('band', band))
+
+    # configure: Changes the model complexity and input width of the workers' HandTrackers
+    def configure(self, model_complexity, input_width):
+        for requests in self.requests:
+            requests.put(('configure', (model_complexity, input_width)))
+
+    # slot: Returns the buffer to write the next frame into before publishing it, or None if the ring is full
+    def slot(self):
+        if not self.free:
+            return None
+        return self.ring.frames[self.free[-1]]
+
+    # publish: Queues the frame written into slot() for inference, tagged with frame_id
+    def publish(self, frame_id):
+        slot = self.free.pop()
+        worker = self.queued.index(min(self.queued))
+        self.slot_of[frame_id] = slot
+        self.worker_of[frame_id] = worker
+        self.queued[worker] += 1
+        self.published[frame_id] = self.metrics.clock()
+        self.requests[worker].put(('frame', (frame_id, slot)))
+
+    # collect: Returns the (frame_id, landmarks) results that are ready, landmarks being the fingers.Landmarks found
+    #          input: timeout - seconds to wait for a result if none are ready yet, 0 to not wait
+    def collect(self, timeout=0):
+        found = []
+        try:
+            found.append(self.results.get(timeout=timeout) if timeout else self.results.get_nowait())
+            while True:
+                found.append(self.results.get_nowait())
+        except queue.Empty:
+            pass
+        for frame_id, landmarks, timings in found:
+            self.free.append(self.slot_of.pop(frame_id))
+            self.queued[self.worker_of.pop(frame_id)] -= 1
+            self.metrics.since('inference_round_trip', self.published.pop(frame_id))
+            self.metrics.add_stages(timings)
+        return [(frame_id, landmarks) for frame_id, landmarks, timings in found]
+
+
+# LocalInference: Runs hand inference straight away in this process, with the same interface as InferenceWorker. The
+#                 HandTracker is built and warmed up on a background thread once started
+class LocalInference:
+    def __init__(self, shape, metrics=None, **tracker_args):
+        self.metrics = metrics
+        self.tracker_args = tracker_args
+        self.hand_tracker = None
+        self.band = tracker_args.get('band')
+        self.settings = None  # (modelComplexity, inputWidth) to configure the HandTracker with before the next frame
+        self.frame = np.empty(shape, dtype=np.uint8)
+        self.done = []
+        self.thread = threading.Thread(target=self._warm_up, name='LocalInference', daemon=True)
+
+    def _warm_up(self):
+        self.hand_tracker = warm_up(self.frame.shape, self.metrics, **self.tracker_args)
+
+    def start(self):
+        self.thread.start()
+
+    def ready(self):
+        return self.hand_tracker is not None
+
+    def stop(self):
+        pass
+
+    def set_band(self, band):
+        self.band = band
+
+    def configure(self, model_complexity, input_width):
+        self.settings = (model_complexity, input_width)
+
+    def slot(self):
+        return self.frame
+
+    def publish(self, frame_id):
+        self.thread.join()
+        self.hand_tracker.band = self.band
+        if self.settings is not None:
+            self.hand_tracker.configure(*self.settings)
+            self.settings = None
+        self.done.append((frame_id, self.hand_tracker.landmarks(self.frame)))
+
+    def collect(self, timeout=0):
+        found, self.done = self.done, []
+        return found
@@ -0,0 +1,292 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# keyboard.py:  Setup phase - finds the keyboard in the reference
+#               image, computes the perspective transform and
+#               segments the keys, all in memory
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from debug import DebugSink
+from fiducial import fiducial_markers
+from keys import KeyIndex
+from merged_hough import hough_merged_image, merge_close
+
+KEYBOARD_CACHE_VERSION = 2
+SETUP_HEIGHT = 1080  # height of the images the pixel distances of the setup phase were tuned on
+
+# The keyboard model, in the warped keyboard image normalised to 0..1 across its width and down its height. The
+# fractions are of the 1920x1080 image the keys were first measured on
+BLACK_KEY_BASE = 380 / 1080  # y of the base of the black keys
+BLACK_KEY_WIDTH = 50 / 1920
+BLACK_KEY_SPACE = 27 / 1920  # space between the black keys of a group
+WHITE_PAIR_EXTRA = 14 / 1920  # extra space between groups, where two white keys are together (such as B and C)
+FIRST_BLACK_KEY = 90 / 1920  # x of the left border of the first black key
+BLACK_THRESHOLD = -5 / 1920  # KeyIndex black_threshold
+WHITE_KEY_COUNT = 29
+
+# SetupParameters: Thresholds of the setup phase that depend on the lighting
+#                  canny1, canny2 - Canny hysteresis thresholds
+#                  hough_threshold, hough_min_length, hough_max_gap - HoughLinesP votes, shortest line and largest gap
+#                  hough_merge - distance within which hough_merged_image merges lines
+#                  merge_distance, merge_angle - distance and angle within which merge_close combines lines
+#                  Lengths and distances are in pixels of a SETUP_HEIGHT high image, see scale_setup_parameters
+SetupParameters = namedtuple('SetupParameters', ['canny1', 'canny2', 'hough_threshold', 'hough_min_length',
+                                                 'hough_max_gap', 'hough_merge', 'merge_distance', 'merge_angle'])
+DEFAULT_SETUP_PARAMETERS = SetupParameters(80, 130, 9, 10, 35, 10, 30, 1)
+
+
+# setup_scale: Factor the pixel distances of the setup phase are multiplied by for an image of the given height
+def setup_scale(height):
+    return height / SETUP_HEIGHT
+
+
+# scale_setup_parameters: Scales the lengths and distances of SetupParameters to an image scale times SETUP_HEIGHT high
+def scale_setup_parameters(parameters, scale):
+    return parameters._replace(hough_min_length=parameters.hough_min_length * scale,
+                               hough_max_gap=parameters.hough_max_gap * scale,
+                               hough_merge=parameters.hough_merge * scale,
+                               merge_distance=parameters.merge_distance * scale)
+
+
+# Keyboard: The keyboard model found by the setup phase
+#           M - homography from the undistorted image to the warped keyboard image
+#           vert - corners of the keyboard in the undistorted image, clockwise from the top left
+#           size - (width, height) of the undistorted image
+#           markers - corners of the fiducial markers in the undistorted image, ordered by marker id
+#           warped_size - (width, height) of the warped keyboard image, the key borders being generated for it
+#           min_y, max_y - top and bottom of the fiducial markers in the undistorted image
+class Keyboard:
+    def __init__(self, M, vert, size, markers, warped_size=None):
+        self.M = M
+        self.vert = vert
+        self.size = size
+        self.markers = markers
+        self.warped_size = tuple(size) if warped_size is None else tuple(warped_size)
+        self.min_y = int(markers[:, :, 1].min())
+        self.max_y = int(markers[:, :, 1].max())
+        self.black_keys, self.white_note_borders, self.black_key_base_coord = segment_keys(*self.warped_size)
+
+    def key_index(self):
+        return key_index(self.warped_size)
+
+    # matches: Checks whether the fiducial markers found in a live frame are where they were during setup
+    #               input: markers - marker corners from fiducial_markers, or None if they were not found
+    #               input: size - (width, height) of the undistorted live frame
+    #               input: tolerance - largest movement of any marker corner, in pixels of a SETUP_HEIGHT high image
+    def matches(self, markers, size, tolerance=4):
+        if markers is None or tuple(size) != tuple(self.size) or markers.shape != self.markers.shape:
+            return False
+        return np.abs(markers - self.markers).max() <= tolerance * setup_scale(self.size[1])
+
+    # corrected: Returns the keyboard moved along with its fiducial markers
+    #               input: markers - where the marker corners are now, in the undistorted image
+    #               The warped keyboard image stays the same, so the key borders are unchanged
+    def corrected(self, markers):
+        # Homography taking the new undistorted image back onto the old one
+        H, _ = cv2.findHomography(markers.reshape(-1, 2), self.markers.reshape(-1, 2))
+        if H is None:
+            return None
+        vert = cv2.perspectiveTransform(self.vert.reshape(-1, 1, 2), np.linalg.inv(H)).reshape(-1, 2)
+        return Keyboard(self.M @ H, vert, self.size, markers, self.warped_size)
+
+
+# save_keyboard: Saves the keyboard model so later runs can skip the setup phase
+def save_keyboard(keyboard, location):
+    np.savez(location, version=KEYBOARD_CACHE_VERSION, M=keyboard.M, vert=keyboard.vert, size=np.array(keyboard.size),
+             markers=keyboard.markers, warped_size=np.array(keyboard.warped_size))
+
+
+# load_keyboard: Loads a keyboard model saved by save_keyboard
+#                output: the Keyboard, or None if there is no cache or it was saved by a different version
+def load_keyboard(location):
+    try:
+        with np.load(location) as cache:
+            if int(cache['version']) != KEYBOARD_CACHE_VERSION:
+                return None
+            return Keyboard(cache['M'], cache['vert'], tuple(int(x) for x in cache['size']), cache['markers'],
+                            tuple(int(x) for x in cache['warped_size']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# find_keyboard: Runs the setup phase on an undistorted reference image of the empty keyboard
+#                input: reference - undistorted reference image
+#                input: debug - DebugSink receiving the intermediate images, or None to discard them
+#                input: parameters - SetupParameters for the lighting, such as those found by autotune.py
+#                input: warped_size - (width, height) of the warped keyboard image, None for the size of the reference
+def find_keyboard(reference, debug=None, parameters=DEFAULT_SETUP_PARAMETERS, warped_size=None):
+    if debug is None:
+        debug = DebugSink()
+
+    # Only the band between the fiducial markers is processed. It is padded with black rows, as if everything
+    # outside it had been blacked out, so the blur and Canny see the same borders as on the full image
+    markers = fiducial_markers(reference)
+    if markers is None:
+        raise Exception("Could not find both fiducial markers")
+    top = int(markers[:, :, 1].min())
+    bottom = int(markers[:, :, 1].max())
+    scale = setup_scale(reference.shape[0])
+    parameters = scale_setup_parameters(parameters, scale)
+    band, band_top = keyboard_band(reference, markers)
+    debug.put('cropped.jpg', band)
+
+    # Image adjustments
+    img = contrast(band, scale)
+    debug.put('contrast.jpg', img)
+
+    # Canny
+    edges = cv2.Canny(img, threshold1=parameters.canny1, threshold2=parameters.canny2)
+    debug.put('canny.jpg', edges)
+
+    # Hough
+    merged_lines_x = hough_merged_image(edges, parameters.hough_threshold, parameters.hough_min_length,
+                                        parameters.hough_max_gap, parameters.hough_merge)
+    debug.put('hough.jpg', draw_lines(band, merged_lines_x))
+
+    # Merge lines
+    merge_close(merged_lines_x, parameters.merge_distance, parameters.merge_angle)
+    debug.put('merged.jpg', draw_lines(band, merged_lines_x))
+
+    ed = keyboard_edges(merged_lines_x, band_top, top, bottom, scale)
+    if len(ed) < 2:
+        raise Exception("Could not find the edges of the keyboard")
+    debug.put('selected_lines.jpg', draw_lines(reference, ed[0:2]))
+
+    # Elongate top line since the keyboard is a little rounded
+    ed[0][0] = (ed[0][0][0] - 10 * scale, ed[0][0][1])
+    ed[0][1] = (ed[0][1][0] + 10 * scale, ed[0][1][1])
+
+    # Corners of keyboard taken from the reference image for perspective transform
+    vert = [(0, 0)] * 4
+    vert[0] = ed[0][0]
+    vert[1] = ed[0][1]
+    vert[2] = ed[1][1]
+    vert[3] = ed[1][0]
+    vert = np.float32(vert)
+
+    # Corners of output for perspective transform
+    size = (reference.shape[1], reference.shape[0])
+    width, height = size if warped_size is None else warped_size
+    outs = np.float32([(0, 0), (width, 0), (width, height), (0, height)])
+
+    # Perspective transform
+    M = cv2.getPerspectiveTransform(vert, outs)
+
+    keyboard = Keyboard(M, vert, size, markers, (width, height))
+
+    out = cv2.warpPerspective(reference, M, (width, height))
+    debug.put('transformed.jpg', out)  # save perspective transform image
+    perspective_keys = out.copy()
+    draw_white_keys(round(keyboard.black_key_base_coord), height, perspective_keys, keyboard.white_note_borders)
+    draw_black_keys(round(keyboard.black_key_base_coord), height, perspective_keys, keyboard.black_keys)
+    debug.put('transformed_withlines.jpg', perspective_keys)  # saves drawn on lines
+
+    return keyboard
+
+
+# keyboard_edges: Finds the keyboard edges among the merged lines of the band
+#                 input: band_top - row of the reference image the band starts at
+#                 input: top, bottom - top and bottom of the fiducial markers in the reference image
+#                 input: scale - setup_scale of the reference image
+#                 output: the horizontal lines between the fiducial markers from top to bottom, in reference image
+#                         coordinates - the first two are the keyboard edges
+def keyboard_edges(lines, band_top, top, bottom, scale=1.0):
+    # Find two longest lines between the fiducial markers - they are the keyboard edges
+    lowest = bottom - 40 * scale
+    horizontals = []
+    for line in lines:
+        line = [(x, y + band_top) for x, y in line]
+        if top < line[0][1] < lowest and top < line[1][1] < lowest:
+            horizontals.append(sorted(line))
+    ed = sorted(horizontals, key=lambda x: (x[0][0] - x[1][0]) ** 2 + (x[0][1] - x[1][1]) ** 2, reverse=True)
+    for e in ed[0:2]:
+        e.sort()
+
+    # Sort from top to bottom
+    ed.sort(key=lambda x: x[0][1])
+    return ed
+
+
+# keyboard_band: Crops the rows between the fiducial markers out of the reference image, padded with black rows, 4 at
+#                SETUP_HEIGHT
+#                output: (band, band_top) - the padded band, and the row of the reference image its first row is at
+def keyboard_band(reference, markers):
+    scale = setup_scale(reference.shape[0])
+    padding = max(round(4 * scale), 1)
+    top = int(markers[:, :, 1].min())
+    bottom = int(markers[:, :, 1].max())
+    band_top = max(top - round(20 * scale), 0) - padding
+    band = cv2.copyMakeBorder(reference[band_top + padding:bottom], padding, padding, 0, 0, cv2.BORDER_CONSTANT)
+    return band, band_top
+
+
+# contrast: Blurs the keys together and thresholds the band into a grayscale image of the white keys for Canny
+#           input: scale - setup_scale of the reference image the band was cropped from
+def contrast(band, scale=1.0):
+    img = cv2.blur(band, (max(round(20 * scale), 1), max(round(5 * scale), 1)))
+    img = cv2.addWeighted(img, 10, img, 0, -1500)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+# segment_keys: Generates the borders of the keys in a warped keyboard image of the given size from the normalised
+#               keyboard model
+#               output: black_keys - [left, right] borders of each black key
+#               output: white_note_borders - borders between the white keys
+#               output: black_key_base_coord - y coordinate of the base of the black keys
+def segment_keys(width, height):
+    black_key_base_coord = round(BLACK_KEY_BASE * height, 6)  # coordinate of base of black keys
+    space = BLACK_KEY_SPACE  # distance between black keys
+    extra_y = WHITE_PAIR_EXTRA  # extra distance when two white keys together (such as between C and B)
+    key = BLACK_KEY_WIDTH  # width of black key
+
+    spaces = np.array(
+        [
+            FIRST_BLACK_KEY,
+            key, space, key, space, key, 2 * space + extra_y, key, space, key,  # One octave (in reverse)
+                                         2 * space + extra_y,
+            key, space, key, space, key, 2 * space + extra_y, key, space, key,
+                                         2 * space + extra_y,
+            key, space, key, space, key, 2 * space + extra_y, key, space, key,
+                                         2 * space + extra_y,
+            key, space, key, space, key, 2 * space + extra_y, key, space, key,
+        ]
+    )
+    # Rounded so the borders land exactly on whole pixels where the model measurements do
+    borders = np.round(np.cumsum(spaces) * width, 6)
+    black_keys = borders.reshape(-1, 2).tolist()
+
+    white_note_borders = np.linspace(0, width, num=WHITE_KEY_COUNT + 1)
+    return black_keys, white_note_borders, black_key_base_coord
+
+
+# key_index: KeyIndex of the keys in a warped keyboard image of the given (width, height)
+def key_index(warped_size):
+    width, height = warped_size
+    return KeyIndex(*segment_keys(width, height), black_threshold=BLACK_THRESHOLD * width)
+
+
+# draw_lines: Returns a copy of the image with the lines drawn on
+def draw_lines(img, lines):
+    img = img.copy()
+    for line in lines:
+        cv2.line(img, (int(line[0][0]), int(line[0][1])), (int(line[1][0]), int(line[1][1])), (0, 0, 255), 4)
+    return img
+
+
+def draw_black_keys(black, height, keyboard, black_keys):
+    for key in black_keys:
+        for x in key:
+            cv2.line(keyboard, (int(x), black), (int(x), height), (0, 255, 0), 4)
+
+
+def draw_white_keys(black, height, keyboard, t):
+    i = 0
+    for num in t:
+        if i in [0, 1, 5, 8, 12, 15, 19, 22, 26, 29]:
+            cv2.line(keyboard, (round(num), 0), (round(num), height), (0, 0, 255), 4)
+        else:
+            cv2.line(keyboard, (round(num), 0), (round(num), black), (0, 0, 255), 4)
+        i += 1
@@ -0,0 +1,169 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# keys.py:  Key geometry index for resolving which fingertips
+#           are on a MIDI key, for all fingertips at once
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import cv2
+import numpy as np
+
+# MIDI notes of the black and white keys, in the order the keys appear from left to right in the warped image
+MIDI_BLACK_KEYS = [82, 80, 78, 75, 73, 70, 68, 66, 63, 61, 58, 56, 54, 51, 49, 46, 44, 42, 39, 37]
+MIDI_WHITE_KEYS = [84, 83, 81, 79, 77, 76, 74, 72, 71, 69, 67, 65, 64, 62, 60, 59, 57, 55, 53, 52, 50, 48, 47, 45, 43,
+                   41, 40, 38, 36]
+MIDI_TO_NOTES = {
+    36: 'C2',
+    37: 'C#/Db2',
+    38: 'D2',
+    39: 'D#/Eb2',
+    40: 'E2',
+    41: 'F2',
+    42: 'F#/Gb2',
+    43: 'G2',
+    44: 'G#/Ab2',
+    45: 'A2',
+    46: 'A#/Bb2',
+    47: 'B2',
+    48: 'C3',
+    49: 'C#/Db3',
+    50: 'D3',
+    51: 'D#/Eb3',
+    52: 'E3',
+    53: 'F3',
+    54: 'F#/Gb3',
+    55: 'G3',
+    56: 'G#/Ab3',
+    57: 'A3',
+    58: 'A#/Bb3',
+    59: 'B3',
+    60: 'C4',
+    61: 'C#/Db4',
+    62: 'D4',
+    63: 'D#/Eb4',
+    64: 'E4',
+    65: 'F4',
+    66: 'F#/Gb4',
+    67: 'G4',
+    68: 'G#/Ab4',
+    69: 'A4',
+    70: 'A#/Bb4',
+    71: 'B4',
+    72: 'C5',
+    73: 'C#/Db5',
+    74: 'D5',
+    75: 'D#/Eb5',
+    76: 'E5',
+    77: 'F5',
+    78: 'F#/Gb5',
+    79: 'G5',
+    80: 'G#/Ab5',
+    81: 'A5',
+    82: 'A#/Bb5',
+    83: 'B5',
+    84: 'C6'
+}
+FINGERS = {
+    0: 'Left Pinky',
+    1: 'Left Ring',
+    2: 'Left Middle',
+    3: 'Left Index',
+    4: 'Left Thumb',
+    5: 'Right Thumb',
+    6: 'Right Index',
+    7: 'Right Middle',
+    8: 'Right Ring',
+    9: 'Right Pinky',
+}
+
+
+# fingering_line: Formats one fingering decision the way it is written to output.txt
+#                 input: finger - index into FINGERS, or None if no finger was on the key
+def fingering_line(key, finger):
+    if finger is None:
+        return MIDI_TO_NOTES[key] + ';missed\n'
+    return MIDI_TO_NOTES[key] + ';' + FINGERS[finger] + '\n'
+
+
+# fingers_transform: Transforms all fingertip points into the warped keyboard image with one perspectiveTransform
+#                    input: M - homography from the undistorted image to the warped keyboard
+#                    input: fingers - sequence of [x, y] fingertip points
+#                    output: (n, 2) integer array of warped points, truncated towards zero
+def fingers_transform(M, fingers):
+    points = np.array(fingers, dtype=np.float32).reshape(-1, 1, 2)
+    return cv2.perspectiveTransform(points, M).reshape(-1, 2).astype(int)
+
+
+# raw_fingers_transform: Transforms fingertip points found in the raw camera frame straight into the warped keyboard
+#                        image, undistorting them and applying M in one undistortPoints call
+#                        input: M - homography from the undistorted image to the warped keyboard
+#                        input: fingers - sequence of [x, y] fingertip points in the raw frame
+#                        output: (n, 2) integer array of warped points, truncated like fingers_transform
+def raw_fingers_transform(M, fingers, camera_matrix, distortion_coeff, new_camera_matrix):
+    points = np.array(fingers, dtype=np.float32).reshape(-1, 1, 2)
+    warped = cv2.undistortPoints(points, camera_matrix, distortion_coeff, P=M @ new_camera_matrix)
+    return warped.reshape(-1, 2).astype(int)
+
+
+# KeyIndex: Boundary arrays of the keys in the warped keyboard image, built once after key segmentation
+#           input: black_keys - [left, right] x borders of each black key, in increasing x
+#           input: white_note_borders - increasing x borders between white keys
+#           input: black_key_base_coord - y coordinate of the base of the black keys
+#           input: black_threshold - distance from a black key's right border within which a white key press is
+#                                    not counted
+class KeyIndex:
+    def __init__(self, black_keys, white_note_borders, black_key_base_coord, black_threshold=-5):
+        black_keys = np.array(black_keys, dtype=float).reshape(-1, 2)
+        self.black_left = black_keys[:, 0]
+        self.black_right = black_keys[:, 1]
+        self.white_borders = np.array(white_note_borders, dtype=float)
+        self.black_key_base_coord = black_key_base_coord
+        self.black_threshold = black_threshold
+
+        self.black_midi = np.array(MIDI_BLACK_KEYS[:len(self.black_left)])
+        self.white_midi = np.array(MIDI_WHITE_KEYS[:len(self.white_borders) - 1])
+        self.notes = {}
+        for i, key in enumerate(self.black_midi):
+            self.notes[int(key)] = (True, i)
+        for i, key in enumerate(self.white_midi):
+            self.notes[int(key)] = (False, i)
+
+    # lookup: Finds the white and the black key under each point, ignoring the black key base line
+    #               input: points - (n, 2) array of warped points
+    #               output: (white, black) - index arrays into the white and black keys, -1 where there is no key
+    def lookup(self, points):
+        x = np.asarray(points)[:, 0]
+
+        # Strictly between white_borders[i] and white_borders[i + 1]
+        white = np.searchsorted(self.white_borders, x, side='left') - 1
+        inside = (white >= 0) & (white < len(self.white_borders) - 1)
+        inside[inside] &= x[inside] < self.white_borders[white[inside] + 1]
+        white[~inside] = -1
+
+        # Strictly between the left and right borders of a black key
+        black = np.searchsorted(self.black_left, x, side='left') - 1
+        inside = black >= 0
+        inside[inside] &= x[inside] < self.black_right[black[inside]]
+        black[~inside] = -1
+
+        return white, black
+
+    # fingers_on: Returns the indices of the points that are on the given MIDI key
+    def fingers_on(self, key, points):
+        points = np.asarray(points)
+        is_black, i = self.notes[key]
+        white, black = self.lookup(points)
+        y = points[:, 1]
+        if is_black:
+            on_note = (black == i) & (y > self.black_key_base_coord)
+        else:
+            t = self.black_threshold
+            x = points[:, :1]
+            near_black = ((self.black_right - t < x) & (x < self.black_right + t)).any(axis=1)
+            on_note = (white == i) & ((y < self.black_key_base_coord) | ~near_black)
+        return np.flatnonzero(on_note)
+
+    # finger_on: Returns the index of the point on the given MIDI key that is highest in the warped image, or None
+    def finger_on(self, key, points):
+        on_note = self.fingers_on(key, points)
+        if len(on_note) == 0:
+            return None
+        return int(on_note[np.argmin(np.asarray(points)[on_note, 1])])
@@ -140,9 +140,121 @@ def hough_merge_pipeline(lines, min):
     return super_lines_final
 
 
+# hough_similar_angle: The angle test used by hough_merge_pipeline
+def hough_similar_angle(line1, line2, min_angle):
+    orientation_i = math.atan2((line1[0][1] - line1[1][1]), (line1[0][0] - line1[1][0]))
+    orientation_j = math.atan2((line2[0][1] - line2[1][1]), (line2[0][0] - line2[1][0]))
+    return int(abs(abs(math.degrees(orientation_i)) - abs(math.degrees(orientation_j)))) < min_angle
+
+
+# hough_segment_distances: Vectorised hough_get_distance over pairs of segments
+#                         input: a, b - (n, 2, 2) arrays of segment endpoints
+def hough_segment_distances(a, b):
+    def point_to_segment(p, s):
+        d = s[:, 1] - s[:, 0]
+        mag = np.hypot(d[:, 0], d[:, 1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = ((p[:, 0] - s[:, 0, 0]) * d[:, 0] + (p[:, 1] - s[:, 0, 1]) * d[:, 1]) / (mag * mag)
+        to_ends = np.minimum(np.hypot(*(p - s[:, 0]).T), np.hypot(*(p - s[:, 1]).T))
+        to_line = np.hypot(p[:, 0] - (s[:, 0, 0] + u * d[:, 0]), p[:, 1] - (s[:, 0, 1] + u * d[:, 1]))
+        dist = np.where((u < 0.00001) | (u > 1), to_ends, to_line)
+        return np.where(mag < 0.00000001, 9999, dist)
+
+    return np.minimum.reduce([point_to_segment(a[:, 0], b), point_to_segment(a[:, 1], b),
+                              point_to_segment(b[:, 0], a), point_to_segment(b[:, 1], a)])
+
+
+# hough_neighbours: Finds, for every segment, the segments close enough and similar enough in angle to be merged
+#                   with it by hough_merge_pipeline. Segments are bucketed by angle and sorted by y within each bucket,
+#                   so only segments in neighbouring angle buckets and overlapping y ranges are compared
+#                   input: min_distance - the segments must be closer than this to be merged
+#                   input: min_angle - the segments must differ in absolute angle by less than this to be merged
+#                   output: list of ascending arrays of segment indices, one per segment
+def hough_neighbours(lines, min_distance, min_angle):
+    n = len(lines)
+    if n == 0:
+        return []
+    segments = np.array(lines, dtype=float).reshape(n, 2, 2)
+    angles = np.abs(np.degrees(np.arctan2(segments[:, 0, 1] - segments[:, 1, 1],
+                                          segments[:, 0, 0] - segments[:, 1, 0])))
+    x_min, x_max = segments[:, :, 0].min(axis=1), segments[:, :, 0].max(axis=1)
+    y_min, y_max = segments[:, :, 1].min(axis=1), segments[:, :, 1].max(axis=1)
+    extent = (y_max - y_min).max()
+
+    # Sort by angle bucket, then by the top of each segment, on one key so every bucket is a contiguous run
+    buckets = np.floor(angles / min_angle)
+    span = y_max.max() - y_min.min() + 2 * (min_distance + extent) + 1
+    sort_key = buckets * span + (y_min - y_min.min())
+    order = np.argsort(sort_key, kind='stable')
+    sort_key = sort_key[order]
+
+    # Candidate pairs: same or neighbouring angle bucket and y ranges within min_distance of each other
+    first, second = [], []
+    for offset in (-1, 0, 1):
+        base = (buckets + offset) * span - y_min.min()
+        low = np.searchsorted(sort_key, base + y_min - min_distance - extent, side='left')
+        high = np.searchsorted(sort_key, base + y_max + min_distance, side='right')
+        counts = high - low
+        first.append(np.repeat(np.arange(n), counts))
+        starts = np.repeat(low - np.cumsum(counts) + counts, counts)
+        second.append(order[starts + np.arange(counts.sum())])
+    first, second = np.concatenate(first), np.concatenate(second)
+
+    # Cheap vectorised rejection, with a little slack so rounding never drops a true neighbour
+    slack = 0.000001
+    keep = (x_min[second] <= x_max[first] + min_distance) & (x_min[first] <= x_max[second] + min_distance)
+    keep &= np.abs(angles[first] - angles[second]) < min_angle + slack
+    first, second = first[keep], second[keep]
+    distances = hough_segment_distances(segments[first], segments[second])
+    keep = distances < min_distance + slack
+    first, second, distances = first[keep], second[keep], distances[keep]
+
+    # Pairs within the slack of either threshold are confirmed with the exact scalar tests of hough_merge_pipeline
+    borderline = np.flatnonzero((distances > min_distance - slack) |
+                                (np.abs(angles[first] - angles[second]) > min_angle - slack))
+    keep = np.ones(len(first), dtype=bool)
+    for k in borderline.tolist():
+        i, j = first[k], second[k]
+        keep[k] = hough_get_distance(lines[i], lines[j]) < min_distance and hough_similar_angle(lines[i], lines[j],
+                                                                                                 min_angle)
+    first, second = first[keep], second[keep]
+
+    pairs = np.lexsort((second, first))
+    first, second = first[pairs], second[pairs]
+    return np.split(second, np.searchsorted(first, np.arange(1, n)))
+
+
+# hough_merge_indexed: Produces the same merged lines as hough_merge_pipeline, using hough_neighbours instead of
+#                      comparing every segment against every member of every group. The order dependent grouping of
+#                      hough_merge_pipeline is replayed on the neighbour lists: a segment joins the first group holding
+#                      one of its neighbours, otherwise it starts a new group with all of its neighbours
+#                      input: min - changeable for the minimum distance the segments must be apart to be merged
+def hough_merge_indexed(lines, min):
+    min_angle_to_merge = 10
+    neighbours = hough_neighbours(lines, min, min_angle_to_merge)
+
+    no_group = len(lines) + 1
+    first_group = np.full(len(lines), no_group)  # lowest index of a group holding each segment
+    groups = []
+    for i, near in enumerate(neighbours):
+        group = first_group[near].min() if len(near) else no_group
+        if group != no_group:
+            groups[group].append(i)
+            if group < first_group[i]:
+                first_group[i] = group
+        else:
+            first_group[i] = len(groups)
+            first_group[near] = len(groups)
+            groups.append([i] + near.tolist())
+
+    return [hough_sort([lines[i] for i in group]) for group in groups]
+
+
 def hough_merged_image(img, g1, g2, g3, min):
 
     lines = cv2.HoughLinesP(img, 1, np.pi / 180, threshold=g1, minLineLength=g2, maxLineGap=g3)
+    if lines is None:
+        return []
     _lines = []
     for line in lines:
         for leftx, boty, rightx, topy in line:
@@ -189,18 +301,43 @@ def combine(line1, line2, thresh_dist, thresh_angle):
         return new_line
 
 
+# merge_close: Repeatedly replaces pairs of lines with the line joining them, as decided by combine
+#              Only pairs with endpoints within thresh_dist of each other can be combined, so those are found with
+#              NumPy and every other pair is skipped, keeping only combine's side effect of sorting both lines
 def merge_close(lines, thresh_dist, thresh_angle):
+    ends = np.array(lines, dtype=float).reshape(-1, 2, 2)
+    touched = np.zeros(len(lines), dtype=bool)  # lines already sorted by an earlier comparison
+
+    def sort_lines(indices):
+        for k in indices[~touched[indices]]:
+            lines[k].sort()
+        touched[indices] = True
+
     i = 0
     while i < len(lines):
         j = i + 1
         while j < len(lines):
+            offsets = ends[j:, :, None, :] - ends[i][None, None, :, :]
+            gaps = np.hypot(offsets[..., 0], offsets[..., 1]).min(axis=(1, 2))
+            near = np.flatnonzero(gaps < thresh_dist + 0.000001)
+            stop = j + near[0] if len(near) else len(lines)
+            if stop > j:
+                sort_lines(np.array([i]))
+                sort_lines(np.arange(j, stop))
+            if stop == len(lines):
+                break
+            j = stop
+
             line1 = lines[i]
             line2 = lines[j]
             new_line = combine(line1, line2, thresh_dist, thresh_angle)
+            touched[[i, j]] = True
             if new_line:
                 lines.pop(j)
                 lines.pop(i)
                 lines.append(new_line)
+                ends = np.concatenate((np.delete(ends, [i, j], axis=0), np.array([new_line], dtype=float)))
+                touched = np.append(np.delete(touched, [i, j]), True)
 
                 j = i + 1
             else:
@@ -218,5 +355,5 @@ def flatten_and_merge(_lines, min):
             # print(abs(math.degrees(orientation_i)))
             _lines_x.append(line_i)
     _lines_x = sorted(_lines_x, key=lambda _line: _line[0][0])
-    merged_lines_x = hough_merge_pipeline(_lines_x, min)
+    merged_lines_x = hough_merge_indexed(_lines_x, min)
     return merged_lines_x
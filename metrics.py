@@ -0,0 +1,216 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# metrics.py:  Low overhead timing histograms and counters for the
+#              real time loop, exported periodically to a text file
+#              in the Prometheus text format
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import bisect
+import os
+import threading
+import time
+
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+# Histogram: Counts of observed values in fixed buckets, with their sum
+class Histogram:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket counts everything above the largest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Metrics: Stage timing histograms, other histograms in ms, counters and gauges, written to location every interval
+#          seconds by a background thread
+#          Stages are timed by chaining clock and since:
+#              t = metrics.clock()
+#              ...
+#              t = metrics.since('undistort', t)
+#          input: prefix - prefix of every exported metric name
+class Metrics:
+    enabled = True
+
+    def __init__(self, location, interval=10, prefix='piano'):
+        self.location = location
+        self.interval = interval
+        self.prefix = prefix
+        self.histograms = {}  # (name, stage) -> Histogram, stage being None for histograms that are not stages
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='Metrics', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.export()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    @staticmethod
+    def clock():
+        return time.perf_counter()
+
+    # since: Records the time since start against a stage and returns the current clock
+    def since(self, stage, start):
+        now = time.perf_counter()
+        self._observe('stage', stage, (now - start) * 1000)
+        return now
+
+    # add_stages: Records (stage, ms) timings measured elsewhere, such as in the inference worker
+    def add_stages(self, timings):
+        for stage, value in timings:
+            self._observe('stage', stage, value)
+
+    # observe: Records a value in ms in its own histogram, such as the latency from a MIDI event to its decision
+    def observe(self, name, value):
+        self._observe(name, None, value)
+
+    def _observe(self, name, stage, value):
+        with self.lock:
+            histogram = self.histograms.get((name, stage))
+            if histogram is None:
+                histogram = self.histograms[(name, stage)] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    # text: The metrics in the Prometheus text format
+    def text(self):
+        lines = []
+        with self.lock:
+            families = {}
+            for (name, stage), histogram in sorted(self.histograms.items(), key=lambda item: (item[0][0],
+                                                                                               item[0][1] or '')):
+                families.setdefault(name, []).append((stage, histogram))
+            for name, histograms in families.items():
+                metric = '%s_%s_ms' % (self.prefix, name)
+                lines.append('# TYPE %s histogram' % metric)
+                for stage, histogram in histograms:
+                    label = '' if stage is None else 'stage="%s",' % stage
+                    total = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        total += count
+                        lines.append('%s_bucket{%sle="%s"} %d' % (metric, label, bound, total))
+                    label = '' if stage is None else '{stage="%s"}' % stage
+                    lines.append('%s_sum%s %.6f' % (metric, label, histogram.sum))
+                    lines.append('%s_count%s %d' % (metric, label, histogram.count))
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE %s_%s_total counter' % (self.prefix, name))
+                lines.append('%s_%s_total %d' % (self.prefix, name, value))
+            for name, value in sorted(self.gauges.items()):
+                lines.append('# TYPE %s_%s gauge' % (self.prefix, name))
+                lines.append('%s_%s %s' % (self.prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+    # export: Writes the metrics to a temporary file and renames it over location, so scrapers never see half a file
+    def export(self):
+        temporary = self.location + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write(self.text())
+        os.replace(temporary, self.location)
+
+
+# Timings: Collects stage timings to be handed to Metrics.add_stages, for code running in another process
+class Timings:
+    enabled = True
+
+    def __init__(self):
+        self.timings = []
+
+    @staticmethod
+    def clock():
+        return time.perf_counter()
+
+    def since(self, stage, start):
+        now = time.perf_counter()
+        self.timings.append((stage, (now - start) * 1000))
+        return now
+
+    # drain: Returns the timings collected since the last drain
+    def drain(self):
+        timings, self.timings = self.timings, []
+        return timings
+
+
+# StartupTimer: Seconds from the start of the program to each step of startup, reported once it is ready
+class StartupTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.steps = []  # (step, seconds since start)
+
+    # mark: Records that a step has just finished, once
+    def mark(self, step):
+        if step not in self.marked():
+            self.steps.append((step, time.perf_counter() - self.start))
+
+    def marked(self):
+        return [step for step, seconds in self.steps]
+
+    # report: One line per step, with the seconds since start and since the step before
+    def report(self):
+        lines = []
+        previous = 0.0
+        for step, seconds in self.steps:
+            lines.append('%-20s %7.3f s  (+%.3f s)' % (step, seconds, seconds - previous))
+            previous = seconds
+        return '\n'.join(lines)
+
+    # gauges: Sets a startup_<step>_seconds gauge in Metrics for every step
+    def gauges(self, metrics):
+        for step, seconds in self.steps:
+            metrics.set('startup_%s_seconds' % step, '%.3f' % seconds)
+
+
+# NullMetrics: Has the interface of Metrics and Timings but does nothing, for when instrumentation is switched off
+class NullMetrics:
+    enabled = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @staticmethod
+    def clock():
+        return 0
+
+    def since(self, stage, start):
+        return 0
+
+    def add_stages(self, timings):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def increment(self, name, amount=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def drain(self):
+        return []
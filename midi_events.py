@@ -0,0 +1,49 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# midi_events.py:  Reading MIDI NOTE ON events and grouping the
+#                  ones played together into chords
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+MIDI_KEY_DOWN = 0x90
+MIDI_READ_SIZE = 1024  # most events taken from the MIDI input in one read
+
+
+# note_ons: Picks the NOTE ON events out of events returned by pygame's midi.Input.read
+#           output: list of (timestamp, key) tuples
+def note_ons(events):
+    return [(timestamp, data[1]) for data, timestamp in events if data[0] == MIDI_KEY_DOWN]
+
+
+# read_events: Drains every pending event from the MIDI input
+def read_events(midi_input):
+    found = []
+    while midi_input.poll():
+        found += midi_input.read(MIDI_READ_SIZE)
+    return found
+
+
+# ChordGrouper: Groups NOTE ONs into chords. A chord is every note starting within window ms of its first note,
+#               and is handed out once that window has passed, so notes that arrive in separate reads still share
+#               a chord
+#               input: window - length of a chord in ms, 0 to hand out every read's notes straight away
+class ChordGrouper:
+    def __init__(self, window=30):
+        self.window = window
+        self.pending = []
+
+    # add: Adds (timestamp, key) NOTE ONs, in the order they were played
+    def add(self, notes):
+        self.pending += notes
+
+    # ready: Returns the chords whose window has closed by the time now, each a list of (timestamp, key)
+    def ready(self, now):
+        chords = []
+        while self.pending:
+            start = self.pending[0][0]
+            if now - start < self.window:
+                break
+            size = 1
+            while size < len(self.pending) and self.pending[size][0] - start <= self.window:
+                size += 1
+            chords.append(self.pending[:size])
+            self.pending = self.pending[size:]
+        return chords
@@ -0,0 +1,62 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# motion_gate.py:  Cheap check of whether hands are over the keys,
+#                  by differencing a low resolution copy of the band
+#                  around the keyboard against the empty keyboard
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import math
+
+import cv2
+import numpy as np
+
+
+# MotionGate: Marks raw camera frames as having hands over the keys or not, so hand inference can be skipped while
+#             the keyboard is idle
+#             input: reference - raw camera frame of the empty keyboard, such as the one the setup phase used
+#             input: band - (top, bottom) rows of the raw frame around the keys
+#             input: width - about the width the band is downscaled to before differencing
+#             input: threshold - grey level difference from the reference at which a pixel counts as changed
+#             input: min_fraction - fraction of changed pixels in the band at which hands are present
+#             input: hold - ms hands stay present after the last change, so inference keeps running between
+#                           movements and while the hands are still
+#             input: adapt - weight of each idle frame in the reference, so it follows slow changes in the lighting
+class MotionGate:
+    def __init__(self, reference, band, width=160, threshold=25, min_fraction=0.005, hold=1500, adapt=0.05):
+        self.threshold = threshold
+        self.min_fraction = min_fraction
+        self.hold = hold
+        self.adapt = adapt
+        self.factor = max(round(reference.shape[1] / width), 1)  # whole number, for the fast path of INTER_AREA
+        self.last_motion = -math.inf  # timestamp of the last frame with changes
+        self.present = True
+        self.changed = 0.0  # fraction of the band changed in the last frame
+        self.reset(reference, band)
+
+    # reset: Starts again from a new reference frame of the empty keyboard and band of rows
+    def reset(self, reference, band):
+        h = reference.shape[0]
+        top = min(max(int(band[0]), 0), h - self.factor)
+        bottom = min(max(int(math.ceil(band[1])), top + self.factor), h)
+        self.rows = (top, bottom - (bottom - top) % self.factor)
+        self.reference = self._small(reference).astype(np.float32)
+        self.last_motion = -math.inf
+
+    def _small(self, image):
+        top, bottom = self.rows
+        size = (image.shape[1] // self.factor, (bottom - top) // self.factor)
+        small = cv2.resize(image[top:bottom, :size[0] * self.factor], size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    # update: Checks one raw frame for hands over the keys
+    #         input: timestamp - capture timestamp of the frame in ms
+    #         output: whether hands are present
+    def update(self, image, timestamp):
+        small = self._small(image)
+        difference = cv2.absdiff(small.astype(np.float32), self.reference)
+        self.changed = np.count_nonzero(difference > self.threshold) / difference.size
+        if self.changed >= self.min_fraction:
+            self.last_motion = timestamp
+        elif timestamp - self.last_motion > self.hold:
+            cv2.accumulateWeighted(small, self.reference, self.adapt)
+        self.present = timestamp - self.last_motion <= self.hold
+        return self.present
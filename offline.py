@@ -0,0 +1,134 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# offline.py:  Offline processing of recorded sessions through the
+#              same undistort, fingers_find, fingertip tracking and
+#              key lookup path as the real time phase, sharded
+#              across processes
+#
+#              Usage: python offline.py sessions/lesson1 sessions/lesson2 ... [--workers N]
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import argparse
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from keys import fingers_transform
+from midi_events import ChordGrouper, note_ons
+from output_writer import FingeringWriter
+from piano import HAND_BAND_MARGIN, INFERENCE_INTERVAL
+from remap import apply_maps, build_maps
+from session import Session
+from tracker import FingertipTracker
+
+SEEK_GAP = 15  # frames to skip before seeking instead of reading through them
+TRACK_LEAD = 500  # ms before each chord from which the fingertips are tracked
+
+
+# read_frames: Decodes only the frames at the given indices of a video
+#              input: indices - ascending frame indices
+#              output: generator of (index, frame) tuples
+def read_frames(video, indices):
+    cap = cv2.VideoCapture(video)
+    position = 0
+    for index in indices:
+        if index - position > SEEK_GAP:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            position = index
+        while position < index:
+            cap.grab()
+            position += 1
+        success, image = cap.read()
+        position += 1
+        if not success:
+            break
+        yield index, image
+    cap.release()
+
+
+# process_session: Works out the fingering of every NOTE ON in a recorded session and writes it to a file in the
+#                  session folder, in the same formats as the real time phase
+#                  Like the real time phase, hand inference runs every inference_interval ms and feeds a
+#                  FingertipTracker, and each chord is resolved once an inference from after it has been added, from
+#                  the fingertips interpolated at each note's timestamp. Inference only runs from TRACK_LEAD ms
+#                  before each chord, as the gated real time phase would while the keyboard is idle
+#                  input: band_margin - fraction of the frame height above and below the fiducial markers given to
+#                                       hand inference
+#                  input: output_name - name of the output file, its extension choosing the format
+#                  output: (directory, number of notes processed)
+def process_session(directory, chord_window=30, band_margin=HAND_BAND_MARGIN, input_width=960,
+                    inference_interval=INFERENCE_INTERVAL, output_name='output.txt'):
+    from fingers import HandTracker
+
+    session = Session(directory)
+    keyboard = session.keyboard
+    key_index = keyboard.key_index()
+    w, h = keyboard.size
+    new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(session.camera_matrix, session.distortion_coeff, (w, h),
+                                                           1, (w, h))
+    undistort_maps = build_maps(session.camera_matrix, session.distortion_coeff, new_camera_matrix, (w, h))
+
+    # Chords, and the frames inferred around them, every inference_interval ms until one after the chord's last note
+    grouper = ChordGrouper(chord_window)
+    grouper.add(note_ons(session.midi_events()))
+    chords = grouper.ready(math.inf)
+    times = [np.arange(chord[0][0] - TRACK_LEAD, chord[-1][0] + 2 * inference_interval, inference_interval)
+             for chord in chords]
+    frames = sorted(set(session.nearest_frames(np.concatenate(times)).tolist())) if times else []
+
+    margin = round(band_margin * h)
+    hand_tracker = HandTracker(band=(keyboard.min_y - margin, keyboard.max_y + margin), inputWidth=input_width,
+                               draw=False)
+    tracker = FingertipTracker()
+    writer = FingeringWriter(os.path.join(directory, output_name))
+    for index, image in read_frames(session.video, frames):
+        new_img = apply_maps(image, undistort_maps)
+        tracker.update(int(session.frame_timestamps[index]), hand_tracker.fingers_find(new_img, w, h))
+        while chords and tracker.updated_at >= chords[0][-1][0]:
+            write_chord(writer, chords.pop(0), tracker, keyboard.M, key_index)
+
+    # Chords at the end of the video are resolved by extrapolating, as the real time phase does after CHORD_MAX_WAIT
+    for chord in chords:
+        write_chord(writer, chord, tracker, keyboard.M, key_index)
+    writer.close()
+    return directory, writer.count
+
+
+# write_chord: Decides the finger that played each note of a chord from the fingertips interpolated at the note's
+#              timestamp, and writes the decisions
+def write_chord(writer, chord, tracker, M, key_index):
+    for timestamp, key in chord:
+        finger_points = fingers_transform(M, tracker.positions_at(timestamp))
+        finger = key_index.finger_on(key, finger_points)
+        writer.write(timestamp, key, finger, None if finger is None else finger_points[finger])
+
+
+# process_sessions: Processes many sessions, one per worker process at a time
+#                   input: workers - number of processes, or None for one per CPU
+def process_sessions(directories, workers=None, **options):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(process_session, directory, **options) for directory in directories]
+        for future in futures:
+            yield future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Work out the fingering of recorded sessions')
+    parser.add_argument('sessions', nargs='+', help='session folders recorded by piano.py')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--chord-window', type=int, default=30, help='ms within which NOTE ONs form one chord')
+    parser.add_argument('--output', default='output.txt',
+                        help='output file name in each session folder, .txt, .csv, .jsonl or .bin')
+    args = parser.parse_args()
+
+    for directory, notes in process_sessions(args.sessions, args.workers, chord_window=args.chord_window,
+                                             output_name=args.output):
+        print(directory, notes, 'notes')
+
+
+if __name__ == '__main__':
+    main()
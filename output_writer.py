@@ -0,0 +1,145 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# output_writer.py:  Streams fingering decisions to disk as they are
+#                    made, from a background thread, so a crash only
+#                    loses the decisions since the last flush
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import csv
+import json
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+from keys import FINGERS, MIDI_TO_NOTES, fingering_line
+
+# Fixed-width little endian binary record: MIDI timestamp in ms, MIDI note, finger index (-1 if missed), and the x and y
+# of the fingertip in the warped keyboard image (0 if missed). Output merged from several stations starts each record
+# with the index of the station
+BINARY_RECORD = struct.Struct('<qBbii')
+BINARY_DTYPE = np.dtype([('timestamp', '<i8'), ('note', 'u1'), ('finger', 'i1'), ('x', '<i4'), ('y', '<i4')])
+BINARY_STATION_RECORD = struct.Struct('<BqBbii')
+BINARY_STATION_DTYPE = np.dtype([('station', 'u1')] + BINARY_DTYPE.descr)
+CSV_HEADER = ['timestamp', 'note', 'note_name', 'finger', 'finger_name', 'x', 'y']
+FORMATS = {'.txt': 'txt', '.csv': 'csv', '.jsonl': 'jsonl', '.bin': 'bin'}
+
+
+# FingeringWriter: Appends each fingering decision to a file from a background thread, flushing it to disk every
+#                  flush_interval seconds
+#                  input: location - file to write, its extension choosing the format unless format is given
+#                  input: format - 'txt' for the note;finger lines of output.txt, 'csv', 'jsonl' or 'bin' for
+#                                  BINARY_RECORD records
+#                  input: append - add to an existing file instead of starting a new one
+#                  input: stations - names of the stations whose decisions are merged into this file, each record
+#                                    starting with its station's name, or its index for 'bin'. None for one station
+class FingeringWriter:
+    def __init__(self, location, format=None, flush_interval=1.0, append=False, stations=None):
+        if format is None:
+            format = FORMATS.get(os.path.splitext(location)[1].lower(), 'txt')
+        if format not in FORMATS.values():
+            raise ValueError("Unknown output format " + format)
+        self.location = location
+        self.format = format
+        self.flush_interval = flush_interval
+        self.stations = stations
+        self.count = 0
+
+        if format == 'bin':
+            self.file = open(location, 'ab' if append else 'wb')
+        else:
+            self.file = open(location, 'a' if append else 'w', newline='')
+        if format == 'csv':
+            self.csv = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.csv.writerow(CSV_HEADER if stations is None else ['station'] + CSV_HEADER)
+
+        self.records = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name='FingeringWriter', daemon=True)
+        self.thread.start()
+
+    # write: Queues one decision, never waiting on the disk
+    #               input: timestamp - MIDI timestamp of the NOTE ON
+    #               input: key - MIDI note
+    #               input: finger - index into FINGERS, or None if no finger was on the key
+    #               input: point - [x, y] of the fingertip in the warped keyboard image, or None if missed
+    #               input: station - name of the station the decision came from, when merging stations
+    def write(self, timestamp, key, finger, point=None, station=None):
+        if finger is None or point is None:
+            point = (0, 0)
+        self.records.put((station, int(timestamp), int(key), finger, int(point[0]), int(point[1])))
+
+    def _run(self):
+        last_flush = time.monotonic()
+        unflushed = False
+        while True:
+            try:
+                record = self.records.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = ()
+            if record is None:
+                break
+            if record:
+                self._encode(*record)
+                self.count += 1
+                unflushed = True
+            if unflushed and time.monotonic() - last_flush >= self.flush_interval:
+                self._flush()
+                unflushed = False
+                last_flush = time.monotonic()
+        self._flush()
+
+    def _encode(self, station, timestamp, key, finger, x, y):
+        merged = self.stations is not None
+        if self.format == 'txt':
+            self.file.write((station + ';' if merged else '') + fingering_line(key, finger))
+        elif self.format == 'csv':
+            self.csv.writerow(([station] if merged else []) + [timestamp, key, MIDI_TO_NOTES[key],
+                                                              '' if finger is None else finger,
+                                                              'missed' if finger is None else FINGERS[finger], x, y])
+        elif self.format == 'jsonl':
+            record = {'station': station} if merged else {}
+            record.update({'timestamp': timestamp, 'note': key, 'note_name': MIDI_TO_NOTES[key], 'finger': finger,
+                           'finger_name': None if finger is None else FINGERS[finger], 'x': x, 'y': y})
+            self.file.write(json.dumps(record) + '\n')
+        elif merged:
+            self.file.write(BINARY_STATION_RECORD.pack(self.stations.index(station), timestamp, key,
+                                                       -1 if finger is None else finger, x, y))
+        else:
+            self.file.write(BINARY_RECORD.pack(timestamp, key, -1 if finger is None else finger, x, y))
+
+    def _flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # close: Writes out every queued decision and closes the file
+    def close(self):
+        self.records.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+# QueueWriter: Has the interface of FingeringWriter but sends each decision to a multiprocessing queue, tagged with the
+#              station, for a supervisor to merge with the decisions of other stations
+class QueueWriter:
+    def __init__(self, decisions, station):
+        self.decisions = decisions
+        self.station = station
+
+    def write(self, timestamp, key, finger, point=None):
+        if finger is None or point is None:
+            point = (0, 0)
+        self.decisions.put((self.station, int(timestamp), int(key), finger, int(point[0]), int(point[1])))
+
+    def close(self):
+        pass
+
+
+# read_binary: Reads a file of binary records into a structured array, ignoring a partly written last record
+#              input: merged - whether the file was merged from several stations
+def read_binary(location, merged=False):
+    dtype = BINARY_STATION_DTYPE if merged else BINARY_DTYPE
+    count = os.path.getsize(location) // dtype.itemsize
+    return np.fromfile(location, dtype=dtype, count=count)
@@ -1,317 +1,499 @@
-import itertools
+import math
+import os
+import time
+from collections import namedtuple
 
 import numpy as np
 import cv2
-from fiducial import *
-from fingers import *
-from merged_hough import *
-from pygame import midi
-import os
+from fiducial import fiducial_markers
+from fingers import LandmarkCache, draw_landmarks, fingertips
+from capture import FrameGrabber
+from remap import UNDISTORT_MAPS_LOCATION, apply_maps, cached_maps, raw_band
+from keys import FINGERS, MIDI_TO_NOTES, fingers_transform, raw_fingers_transform
+from keyboard import find_keyboard, load_keyboard, save_keyboard
+from debug import DebugSink
+from fiducial_monitor import FiducialMonitor
+from midi_events import ChordGrouper, note_ons, read_events
+from motion_gate import MotionGate
+from governor import LatencyGovernor, Level
+from inference_worker import InferenceWorker, LocalInference
+from session import SessionRecorder
+from metrics import Metrics, NullMetrics, StartupTimer
+from output_writer import FingeringWriter, QueueWriter
+from tracker import FingertipTracker
+from preview import Preview, StopControl
+from calibration import CALIBRATION_LOCATION, load_calibration, save_setup_parameters, scale_calibration
+from autotune import tune, tuned_parameters
 
 IMAGE_LOCATION = 'predictions/original.jpg'
-MIDI_KEY_DOWN = 0x90
-MIDI_BLACK_KEYS = [82, 80, 78, 75, 73, 70, 68, 66, 63, 61, 58, 56, 54, 51, 49, 46, 44, 42, 39, 37]
-MIDI_WHITE_KEYS = [84, 83, 81, 79, 77, 76, 74, 72, 71, 69, 67, 65, 64, 62, 60, 59, 57, 55, 53, 52, 50, 48, 47, 45, 43,
-                   41, 40, 38, 36]
+DEBUG_LOCATION = 'predictions'
+SAVE_DEBUG_IMAGES = True
+KEYBOARD_CACHE_LOCATION = './keyboard_cache.npz'
+USE_KEYBOARD_CACHE = True
+AUTO_TUNE = True  # sweep the Canny and Hough parameters on every new reference image, saving the best with the calibration
+FIDUCIAL_CHECK_INTERVAL = 30  # frames processed between checks that the keyboard has not moved
+RECALIBRATE_CLEAR_TIME = 1000  # ms without hands found over the keys before a moved keyboard is found again
+CAPTURE_SIZE = (1920, 1080)  # (width, height) frames are captured at, such as (1280, 720) or (960, 540) to save time
+WARPED_SIZE = None  # (width, height) of the warped keyboard image the keys are generated for, None for CAPTURE_SIZE
+HAND_BAND_MARGIN = 0.185  # fraction of the frame height above and below the fiducial markers given to hand inference
+POINT_UNDISTORT = False  # run hand inference on the raw frames and undistort only the fingertips, no full frame
+                         # undistort is done except for the preview and setup
+HAND_INPUT_WIDTH = 960  # width frames are downscaled to for hand inference, None for full resolution
+CHORD_WINDOW = 30  # ms within which NOTE ONs are resolved as one chord
+INFERENCE_INTERVAL = 66  # ms between hand inferences feeding the fingertip tracker
+CHORD_MAX_WAIT = 150  # ms a chord waits for an inference from after it before its fingertips are extrapolated
+USE_GOVERNOR = True  # step hand inference down through GOVERNOR_LEVELS when the latency budget is not being met
+LATENCY_BUDGET = 140  # ms from key press to decision to aim for
+# ms from a frame's capture to its landmarks reaching the fingertip tracker the governor keeps the 90th percentile
+# within, what is left of LATENCY_BUDGET after a note waits for the next inference
+INFERENCE_BUDGET = LATENCY_BUDGET - INFERENCE_INTERVAL
+# Hand inference settings the governor steps through under load, most accurate first: model complexity, ms between
+# inferences and width frames are downscaled to
+GOVERNOR_LEVELS = [Level(1, INFERENCE_INTERVAL, HAND_INPUT_WIDTH), Level(1, INFERENCE_INTERVAL, 640),
+                   Level(0, INFERENCE_INTERVAL, 640), Level(0, 100, 480), Level(0, 150, 480)]
+USE_INFERENCE_WORKER = True  # run hand inference in a separate process
+METRICS_LOCATION = './metrics.prom'  # text file the real time metrics are exported to, in the Prometheus text format
+METRICS_INTERVAL = 10  # seconds between metrics exports
+USE_METRICS = True  # time the stages of the real time loop, False to switch instrumentation off entirely
+OUTPUT_LOCATION = 'output.txt'  # decisions are streamed here, .txt for note;finger lines, or .csv, .jsonl or .bin
+OUTPUT_FLUSH_INTERVAL = 1.0  # seconds between flushes of the output file to disk
+HEADLESS = False  # run without a window, stopping on SIGINT, SIGTERM or when STOP_FILE is created
+STOP_FILE = './stop'  # create this file, e.g. with touch, to stop the program
+PREVIEW_FPS = 10  # most frames a second shown in the preview window
+SHOW_LANDMARKS = True  # draw the hands of the latest inference onto the preview
+MOTION_GATE = True  # skip hand inference while no hands are over the keys, found by differencing against the reference
+GATE_WIDTH = 160  # width the keyboard band is downscaled to for the motion gate
+GATE_THRESHOLD = 25  # grey level change of a pixel that counts as motion
+GATE_MIN_FRACTION = 0.005  # fraction of the keyboard band that has to change for hands to be present
+GATE_HOLD = 1500  # ms inference keeps running after the last motion over the keys
+LANDMARK_CACHE_SIZE = 8  # frames whose hand landmarks are kept for the preview and any other readers
+REFERENCE_SETTLE_FRAMES = 30  # frames read before the reference image is taken without a window, to settle exposure
+RECORD_LOCATION = None  # folder to record the session into for offline.py, e.g. 'sessions/lesson1', None to not record
 C_MAJOR_FINGERING = [(60, 5), (62, 6), (64, 7), (65, 5), (67, 6), (69, 7), (71, 8), (72, 9)]
-MIDI_TO_NOTES = {
-    36: 'C2',
-    37: 'C#/Db2',
-    38: 'D2',
-    39: 'D#/Eb2',
-    40: 'E2',
-    41: 'F2',
-    42: 'F#/Gb2',
-    43: 'G2',
-    44: 'G#/Ab2',
-    45: 'A2',
-    46: 'A#/Bb2',
-    47: 'B2',
-    48: 'C3',
-    49: 'C#/Db3',
-    50: 'D3',
-    51: 'D#/Eb3',
-    52: 'E3',
-    53: 'F3',
-    54: 'F#/Gb3',
-    55: 'G3',
-    56: 'G#/Ab3',
-    57: 'A3',
-    58: 'A#/Bb3',
-    59: 'B3',
-    60: 'C4',
-    61: 'C#/Db4',
-    62: 'D4',
-    63: 'D#/Eb4',
-    64: 'E4',
-    65: 'F4',
-    66: 'F#/Gb4',
-    67: 'G4',
-    68: 'G#/Ab4',
-    69: 'A4',
-    70: 'A#/Bb4',
-    71: 'B4',
-    72: 'C5',
-    73: 'C#/Db5',
-    74: 'D5',
-    75: 'D#/Eb5',
-    76: 'E5',
-    77: 'F5',
-    78: 'F#/Gb5',
-    79: 'G5',
-    80: 'G#/Ab5',
-    81: 'A5',
-    82: 'A#/Bb5',
-    83: 'B5',
-    84: 'C6'
-}
-FINGERS = {
-    0: 'Left Pinky',
-    1: 'Left Ring',
-    2: 'Left Middle',
-    3: 'Left Index',
-    4: 'Left Thumb',
-    5: 'Right Thumb',
-    6: 'Right Index',
-    7: 'Right Middle',
-    8: 'Right Ring',
-    9: 'Right Pinky',
-}
 
+# Station: One camera and MIDI keyboard pair, with where its files go
+#          name - shown with its decisions, and the preview window title
+#          camera - index of the camera for cv2.VideoCapture
+#          midi_device - MIDI input device id or name, None for the default input
+#          calibration - camera calibration file made by find_camera_calibration.py
+#          directory - folder the keyboard cache, remap tables, debug images, metrics, output and stop file go in
+#          cores - CPU cores the station's processes are pinned to, None to not pin them
+#          inference_workers - hand inference processes
+#          headless - run without a preview window
+#          capture_size - (width, height) the camera is captured at
+Station = namedtuple('Station', ['name', 'camera', 'midi_device', 'calibration', 'directory', 'cores',
+                                 'inference_workers', 'headless', 'capture_size'],
+                     defaults=(None, 0, None, CALIBRATION_LOCATION, '.', None, 1, HEADLESS, CAPTURE_SIZE))
 
-def main():
-    # Create a folder to store intermediate stages of the setup phase
-    if not os.path.exists("predictions"):
-        os.mkdir("predictions")
-
-    # Comment out the line below to use original.jpg instead of taking a new image
-    take_reference_image("predictions/original.jpg")
-
-    # Crop image
-    img = cv2.imread("predictions/original.jpg")
-    top, bottom = fiducial_detect(img)
-    # Set all pixels outside the range to black
-    img[0:top - 20, 0:] = list(itertools.repeat(list(itertools.repeat([0, 0, 0], len(img[0]))), top - 20))
-    img[bottom:1080, 0:] = list(itertools.repeat(list(itertools.repeat([0, 0, 0], len(img[0]))), 1080 - bottom))
-    cv2.imwrite("predictions/cropped.jpg", img)
-
-    # Image adjustments
-    img = cv2.imread("predictions/cropped.jpg")
-    img = cv2.blur(img, (20, 5))
-    img = cv2.addWeighted(img, 10, img, 0, -1500)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    cv2.imwrite('predictions/contrast.jpg', img)
-
-    # Canny
-    img = cv2.imread('predictions/contrast.jpg')
-    edges = cv2.Canny(img, threshold1=80, threshold2=130)
-    cv2.imwrite('predictions/canny.jpg', edges)
-
-    # Hough
-    merged_lines_x = hough_merged_image(edges, 9, 10, 35, 10)
-    img = cv2.imread('predictions/cropped.jpg')
-    for line in merged_lines_x:
-        cv2.line(img, (line[0][0], line[0][1]), (line[1][0], line[1][1]), (0, 0, 255), 4)
-    cv2.imwrite('predictions/hough.jpg', img)
-
-    # Merge lines
-    img = cv2.imread('predictions/cropped.jpg')
-    merge_close(merged_lines_x, 30, 1)
-    for line in merged_lines_x:
-        cv2.line(img, (line[0][0], line[0][1]), (line[1][0], line[1][1]), (0, 0, 255), 4)
-    cv2.imwrite('predictions/merged.jpg', img)
-
-    # Find two longest lines between the fiducial markers - they are the keyboard edges
-    horizontals = []
-    for line in merged_lines_x:
-        if top < line[0][1] < bottom - 40 and top < line[1][1] < bottom - 40:
-            horizontals.append(sorted(line))
-    ed = sorted(horizontals, key=lambda x: (x[0][0] - x[1][0]) ** 2 + (x[0][1] - x[1][1]) ** 2, reverse=True)
-    # Draw the lines onto the image and save
-    p = cv2.imread('predictions/cropped.jpg')
-    for e in ed[0:2]:
-        e.sort()
-        cv2.line(p, e[0], e[1], (0, 0, 255), 4)
-    cv2.imwrite('predictions/selected_lines.jpg', p)
-
-    # Sort from top to bottom
-    ed.sort(key=lambda x: x[0][1])
-
-    # Elongate top line since the keyboard is a little rounded
-    ed[0][0] = (ed[0][0][0] - 10, ed[0][0][1])
-    ed[0][1] = (ed[0][1][0] + 10, ed[0][1][1])
-
-    # Corners of keyboard taken from the reference image for perspective transform
-    vert = [(0, 0)] * 4
-    vert[0] = ed[0][0]
-    vert[1] = ed[0][1]
-    vert[2] = ed[1][1]
-    vert[3] = ed[1][0]
-    vert = np.float32(vert)
-
-    # Corners of output for perspective transform
-    height, width = p.shape[:2]
-    outs = np.float32([(0, 0), (width, 0), (width, height), (0, height)])
-
-    # Perspective transform
-    perspective_image = cv2.imread("predictions/original.jpg")
-    M = cv2.getPerspectiveTransform(vert, outs)
-    out = cv2.warpPerspective(perspective_image, M, (width, height))
-    cv2.imwrite('predictions/transformed.jpg', out)  # save perspective transform image
-
-    # Key segmentation
-    perspective_keys = out.copy()
-    black_key_base_coord = 380  # coordinate of base of black keys
-    space = 27  # distance between black keys
-    extra_y = 14  # extra distance when two white keys together (such as between C and B)
-    key = 50  # width of black key
-
-    spaces = np.array(
-        [
-            90,
-            key, space, key, space, key, 2 * space + extra_y, key, space, key,  # One octave (in reverse)
-                                         2 * space + extra_y,
-            key, space, key, space, key, 2 * space + extra_y, key, space, key,
-                                         2 * space + extra_y,
-            key, space, key, space, key, 2 * space + extra_y, key, space, key,
-                                         2 * space + extra_y,
-            key, space, key, space, key, 2 * space + extra_y, key, space, key,
-        ]
-    )
-    black_keys = []
-    total = 0
-    i = 0
-    while i < len(spaces):
-        key = [total := total + spaces[i], total := total + spaces[i + 1]]
-        black_keys.append(key)
-        i += 2
-
-    white_note_borders = np.linspace(0, width, num=30)
-    draw_white_keys(black_key_base_coord, height, perspective_keys, white_note_borders)
-    draw_black_keys(black_key_base_coord, height, perspective_keys, black_keys)
-
-    cv2.imwrite('predictions/transformed_withlines.jpg', perspective_keys)  # saves drawn on lines
 
-    # REAL TIME PHASE
-    cap = cv2.VideoCapture(0)  # Open the first camera connected to the computer.
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
-    try:
-        camera_matrix = np.loadtxt('./camera_matrix.npy')
-        distortion_coeff = np.loadtxt('./distortion_coeff.npy')
+def main():
+    run(Station())
+
+
+# run: Runs the setup and real time phases for one station until it is stopped
+#      input: station - the Station to run
+#      input: decisions - multiprocessing queue to send the decisions to instead of writing them to OUTPUT_LOCATION,
+#                         as used by supervisor.py
+#      input: stop_event - Event that stops the station when set, in addition to signals and the stop file
+def run(station=Station(), decisions=None, stop_event=None):
+    startup = StartupTimer()
+    from pygame import midi  # pygame is slow to import, so only stations that run load it
+    startup.mark('imports')
+
+    os.makedirs(station.directory, exist_ok=True)
+    if station.cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, station.cores)  # inherited by the inference workers started below
+
+    preview = Preview(window=station.name or 'Image', fps=PREVIEW_FPS, headless=station.headless)
+    stop = StopControl(station_path(station, STOP_FILE), event=stop_event)
+
+    cap = cv2.VideoCapture(station.camera)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, station.capture_size[0])
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, station.capture_size[1])
+    calibration = load_calibration(station.calibration)
+    if calibration is None:
+        raise FileExistsError("Missing camera calibration, run find_camera_calibration.py to create "
+                              + station.calibration)
+    ret, frame = cap.read()
+    h, w = frame.shape[:2]
+    scaled = scale_calibration(calibration, (w, h))
+    if scaled is None:
+        raise ValueError("Camera was calibrated at %dx%d but is running at %dx%d, set a capture size of the same shape "
+                         "or run find_camera_calibration.py to recalibrate %s"
+                         % (calibration.size[0], calibration.size[1], w, h, station.calibration))
+    calibration = scaled
+    camera_matrix, distortion_coeff = calibration.camera_matrix, calibration.distortion_coeff
+    band_margin = round(HAND_BAND_MARGIN * h)
+    warped_size = (w, h) if WARPED_SIZE is None else WARPED_SIZE
+    startup.mark('camera')
+
+    # Hand inference loads MediaPipe and warms up in the background during the setup phase. It only sees the band
+    # around the keyboard once the keyboard is found
+    metrics = Metrics(station_path(station, METRICS_LOCATION), METRICS_INTERVAL) if USE_METRICS else NullMetrics()
+    level = GOVERNOR_LEVELS[0]
+    if USE_INFERENCE_WORKER:
+        inference = InferenceWorker((h, w, 3), slots=max(4, 2 * station.inference_workers),
+                                    workers=station.inference_workers, metrics=metrics,
+                                    modelComplexity=level.model_complexity, inputWidth=level.input_width, draw=False)
+    else:
+        inference = LocalInference((h, w, 3), metrics=metrics, modelComplexity=level.model_complexity,
+                                   inputWidth=level.input_width, draw=False)
+    inference.start()
+    new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion_coeff, (w, h), 1, (w, h))
+
+    # Remap tables for undistorting frames
+    undistort_maps = cached_maps(station_path(station, UNDISTORT_MAPS_LOCATION), camera_matrix, distortion_coeff,
+                                 new_camera_matrix, (w, h))
+
+    # Canny, Hough and merge parameters last tuned for the lighting
+    parameters = tuned_parameters(station.calibration)
+    keyboard_cache = station_path(station, KEYBOARD_CACHE_LOCATION)
+
+    # Reuse the keyboard found by an earlier run if the fiducial markers have not moved since
+    keyboard = load_keyboard(keyboard_cache) if USE_KEYBOARD_CACHE else None
+    empty_frame = None  # raw frame of the empty keyboard, for the motion gate
+    if keyboard is not None:
         ret, frame = cap.read()
-        h, w = frame.shape[:2]
-        new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion_coeff, (w, h), 1, (w, h))
-    except:
-        raise FileExistsError("Missing Camera Matrices and Distortion Files.")
+        empty_frame = frame
+        if not keyboard.matches(fiducial_markers(apply_maps(frame, undistort_maps)), (w, h)):
+            print('Keyboard has moved since the last run, redoing setup')
+            keyboard = None
+
+    if keyboard is None:
+        # Intermediate stages of the setup phase are written to the predictions folder in the background
+        debug = DebugSink(station_path(station, DEBUG_LOCATION) if SAVE_DEBUG_IMAGES else None)
+
+        # Comment out the first line below and uncomment the second to use original.jpg instead of taking a new image
+        empty_frame = take_reference_image(cap, undistort_maps, preview, stop)
+        if empty_frame is None:
+            debug.close()
+            inference.stop()
+            cap.release()
+            return
+        reference = apply_maps(empty_frame, undistort_maps)
+        # reference = cv2.imread(IMAGE_LOCATION)
+        debug.put('original.jpg', reference)
+
+        if AUTO_TUNE:
+            tuned, score, results = tune(reference)
+            if score > 0:
+                parameters = tuned
+                print('Tuned setup parameters to', parameters, 'with a score of %.3f' % score)
+                save_setup_parameters(parameters, station.calibration)
+            else:
+                print('No setup parameters found the keyboard edges, keeping', parameters)
+
+        keyboard = find_keyboard(reference, debug, parameters, warped_size)
+        debug.close()
+        save_keyboard(keyboard, keyboard_cache)
+    M = keyboard.M
+    startup.mark('keyboard')
+
+    # Index of the key borders, so the key under every fingertip is found in one query per note
+    key_index = keyboard.key_index()
 
-    hand_tracker = HandTracker()
+    # REAL TIME PHASE
+    # Stage timings, latency from key press to decision and backlog counts, exported for scraping
+    metrics.start()
+    inference.set_band(hand_band(keyboard, band_margin, calibration, new_camera_matrix))
+
+    # Hand inference and tracking only run while hands are over the keys, or notes are waiting for a decision
+    gate = None
+    if MOTION_GATE:
+        gate = MotionGate(empty_frame, gate_band(keyboard, calibration, new_camera_matrix), GATE_WIDTH, GATE_THRESHOLD,
+                          GATE_MIN_FRACTION, GATE_HOLD)
+
+    # Hand inference runs on the latest frame every inference_interval ms and feeds the fingertip tracker, and every
+    # note is resolved against the fingertips interpolated at its own timestamp
+    inference_interval = level.inference_interval
+    governor = None
+    if USE_GOVERNOR:
+        governor = LatencyGovernor(GOVERNOR_LEVELS, INFERENCE_BUDGET, max_queue=2 * station.inference_workers)
+    tracker = FingertipTracker()
+    landmark_cache = LandmarkCache(LANDMARK_CACHE_SIZE)
+    pending = {}  # frame id -> capture timestamp of the frames waiting for inference
+    waiting = []  # chords waiting for an inference from after them
+    last_inference = None
 
     midi.init()
-    midi_input = midi.Input(midi.get_default_input_id())
-    output = []
-
+    midi_input = midi.Input(midi_input_id(station.midi_device))
+    chords = ChordGrouper(CHORD_WINDOW)
+    if decisions is None:
+        writer = FingeringWriter(station_path(station, OUTPUT_LOCATION), flush_interval=OUTPUT_FLUSH_INTERVAL)
+    else:
+        writer = QueueWriter(decisions, station.name)
+    prefix = '' if station.name is None else station.name + ':'
+
+    # Optionally record the camera stream and MIDI events so the session can be processed again offline
+    recorder = None
+    if RECORD_LOCATION is not None:
+        recorder = SessionRecorder(station_path(station, RECORD_LOCATION), (w, h), camera_matrix, distortion_coeff,
+                                   keyboard)
+
+    # Capture on a background thread, stamping frames with the MIDI clock so key presses can be matched to the
+    # frame from when the key went down
+    grabber = FrameGrabber(cap, midi.time, sink=recorder)
+    grabber.start()
+    frame = None
+
+    # Track the fiducial markers at a low rate to follow small movements of the keyboard
+    monitor = FiducialMonitor(keyboard, camera_matrix, distortion_coeff, new_camera_matrix)
+    monitor.start()
+    keyboard_version = 0
+    frames_processed = 0
+    inferred_at = None  # capture timestamp of the latest frame inferred
+    hands_seen = midi.time()  # capture timestamp of the latest frame hands were found in
+    startup.mark('real_time')
+
+    # Until here Ctrl+C raises KeyboardInterrupt as usual. From here it, SIGTERM, the stop file and stop_event end the
+    # loop so the output is flushed and the workers are shut down
+    stop.install()
     while True:
-        success, new_img = cap.read()
-        new_img = cv2.undistort(new_img, camera_matrix, distortion_coeff, None, new_camera_matrix)
-        height, width = new_img.shape[:2]
-
-        if midi_input.poll():
-            event = midi_input.read(1)
-            if event[0][0][0] == MIDI_KEY_DOWN:
-                warped = cv2.warpPerspective(new_img, M, (width, height))
-                fingers = hand_tracker.fingers_find(new_img, width, height)
-
-                finger_points = tuple(map(lambda finger_point: finger_transform(M, finger_point), fingers))
-
-                for point in finger_points:
-                    cv2.circle(warped, point, 3, (0, 0, 255), 6)
-
-                key = event[0][0][1]
-                fingers_on_note = []
-                if key in MIDI_BLACK_KEYS:
-                    i = MIDI_BLACK_KEYS.index(key)
-                    border = black_keys[i]
-                    for finger, coord in enumerate(finger_points):
-                        if coord[1] > black_key_base_coord and border[0] < coord[0] < border[1]:
-                            fingers_on_note.append((finger, coord))
-                else:
-                    i = MIDI_WHITE_KEYS.index(key)
-                    border = [white_note_borders[i], white_note_borders[i + 1]]
-                    for finger, coord in enumerate(finger_points):
-                        if (coord[1] < black_key_base_coord or not is_black_note(coord, black_keys, -5)) \
-                                and (border[0] < coord[0] < border[1]):
-                            fingers_on_note.append((finger, coord))
-
-                note_name = MIDI_TO_NOTES[key]
-                if fingers_on_note:
-                    finger_name = FINGERS[sorted(fingers_on_note, key=lambda x: x[1][1])[0][0]]
-                    print(note_name, 'played with', finger_name)
-                    output.append(note_name + ';' + finger_name + "\n")
+        t = frame_start = metrics.clock()
+        last_id = None if frame is None else frame.id
+        frame = grabber.latest(last_id)
+        if frame is None:
+            if stop.requested():
+                break
+            continue
+        if last_id is not None and frame.id > last_id + 1:
+            metrics.increment('frames_dropped', frame.id - last_id - 1)
+        t = metrics.since('capture_wait', t)
+
+        frames_processed += 1
+        if frames_processed % FIDUCIAL_CHECK_INTERVAL == 0:
+            monitor.submit(frame.image)
+        # A keyboard moved too far to follow is found again in the background, on a frame without hands. The motion
+        # gate's reference shows the keyboard where it was, so hand inference finding no hands also counts
+        if monitor.needs_recalibration:
+            hands_clear = (gate is not None and not gate.present) or (
+                inferred_at is not None and inferred_at - hands_seen >= RECALIBRATE_CLEAR_TIME)
+            if hands_clear and monitor.recalibrate(frame.image, find_keyboard_raw, undistort_maps, parameters,
+                                                   warped_size):
+                print(prefix + 'Keyboard has moved, redoing setup')
+        if monitor.version != keyboard_version:
+            keyboard_version, keyboard = monitor.current()
+            M = keyboard.M
+            key_index = keyboard.key_index()
+            inference.set_band(hand_band(keyboard, band_margin, calibration, new_camera_matrix))
+            reference = monitor.take_reference()
+            if gate is not None and reference is not None:
+                gate.reset(reference, gate_band(keyboard, calibration, new_camera_matrix))
+            if USE_KEYBOARD_CACHE:
+                save_keyboard(keyboard, keyboard_cache)
+        t = metrics.since('fiducial', t)
+
+        if 'inference_ready' not in startup.marked() and inference.ready():
+            startup.mark('inference_ready')
+        if last_inference is None or frame.timestamp - last_inference >= inference_interval:
+            # Notes waiting for a decision need fingertips even if the gate has not seen the hands
+            hands_present = gate is None or gate.update(frame.image, frame.timestamp) or chords.pending or waiting
+            t = metrics.since('motion_gate', t)
+            buffer = inference.slot() if hands_present else None
+            if not hands_present:
+                metrics.increment('inferences_gated')
+                last_inference = frame.timestamp
+            elif buffer is not None:
+                if POINT_UNDISTORT:
+                    np.copyto(buffer, frame.image)
+                    t = metrics.since('frame_copy', t)
                 else:
-                    print(note_name, 'MISSED')
-                    output.append(note_name + ';missed\n')
-
-        scaled_down = cv2.resize(new_img, (960, 540))
-        cv2.imshow("Image", scaled_down)
-        if cv2.waitKey(1) != -1:
+                    apply_maps(frame.image, undistort_maps, buffer)
+                    t = metrics.since('undistort', t)
+                inference.publish(frame.id)
+                t = metrics.since('publish', t)
+                pending[frame.id] = frame.timestamp
+                last_inference = frame.timestamp
+            else:  # every slot is still waiting for inference
+                metrics.increment('inferences_skipped')
+        # With several workers, results can come back out of order
+        results = inference.collect()
+        collected_at = midi.time()
+        for frame_id, landmarks in sorted(results, key=lambda result: pending[result[0]]):
+            inferred_at = pending.pop(frame_id)
+            if governor is not None:
+                governor.observe(collected_at - inferred_at)
+            if len(landmarks.points):
+                hands_seen = inferred_at
+            landmark_cache.put(frame_id, landmarks)
+            tracker.update(inferred_at, fingertips(landmarks, w, h))
+        t = metrics.since('inference_collect', t)
+
+        events = read_events(midi_input)
+        if recorder is not None:
+            recorder.add_events(events)
+        chords.add(note_ons(events))
+        metrics.increment('midi_events', len(events))
+        now = midi.time()
+        waiting += chords.ready(now)
+
+        # Cheaper hand inference while the latency budget is not met, and back once it is again. Frames published
+        # while hand inference was still warming up wait for it, so windows start once it is ready
+        if governor is not None and 'inference_ready' in startup.marked():
+            previous = governor.index
+            switched = governor.update(now, len(pending))
+            if switched is not None:
+                print(prefix + 'Inference level %d -> %d (%s): model complexity %d, every %d ms, input width %s'
+                      % (previous, governor.index, governor.last_reason, switched.model_complexity,
+                         switched.inference_interval, switched.input_width))
+                inference.configure(switched.model_complexity, switched.input_width)
+                inference_interval = switched.inference_interval
+        t = metrics.since('midi_read', t)
+
+        # A chord is resolved once an inference from after its last note has reached the tracker, or by extrapolating
+        # the fingertips once it has waited CHORD_MAX_WAIT ms
+        while waiting and ((tracker.updated_at is not None and tracker.updated_at >= waiting[0][-1][0])
+                           or now - waiting[0][0][0] > CHORD_MAX_WAIT):
+            resolve_chord(waiting.pop(0), tracker, M, key_index, camera_matrix, distortion_coeff, new_camera_matrix,
+                          writer, metrics, midi.time, prefix)
+            if 'first_decision' not in startup.marked():
+                startup.mark('first_decision')
+                print(prefix + 'Startup times:\n' + startup.report())
+                startup.gauges(metrics)
+        t = metrics.since('key_lookup', t)
+        if metrics.enabled:
+            metrics.set('midi_notes_queued', len(chords.pending) + sum(len(chord) for chord in waiting))
+            metrics.set('frames_awaiting_inference', len(pending))
+            if gate is not None:
+                metrics.set('hands_present', int(gate.present))
+            if governor is not None:
+                governor.gauges(metrics)
+            metrics.set('capture_failed_reads', grabber.failed_reads)
+            if recorder is not None:
+                metrics.set('recording_dropped_frames', recorder.dropped)
+
+        # Only frames that are shown are undistorted and drawn on. With POINT_UNDISTORT, the fingertips and hands are
+        # in raw frame coordinates, so the raw frame is shown
+        if preview.due():
+            image = frame.image.copy() if POINT_UNDISTORT else apply_maps(frame.image, undistort_maps)
+            landmarks = landmark_cache.latest()
+            if SHOW_LANDMARKS and landmarks is not None:
+                draw_landmarks(image, landmarks)
+            preview.show(image, tracker.positions_at(frame.timestamp))
+            if preview.key_pressed():
+                break
+            metrics.since('display', t)
+        if stop.requested():
             break
+        metrics.since('frame', frame_start)
+
+    # Every note read before the stop is still decided, extrapolating the fingertips where no inference followed it
+    events = read_events(midi_input)
+    if recorder is not None:
+        recorder.add_events(events)
+    chords.add(note_ons(events))
+    for chord in waiting + chords.ready(math.inf):
+        resolve_chord(chord, tracker, M, key_index, camera_matrix, distortion_coeff, new_camera_matrix, writer,
+                      metrics, midi.time, prefix)
+
+    inference.stop()
+    monitor.stop()
+    grabber.stop()
+    if recorder is not None:
+        recorder.close()
+    metrics.stop()
+    cap.release()
+    writer.close()
+    preview.close()
+    stop.uninstall()
+
+
+# resolve_chord: Decides the finger that played each note of a chord from the fingertips interpolated at the note's
+#                timestamp, and writes the decisions
+#                input: M - homography from the undistorted image to the warped keyboard
+#                input: camera_matrix, distortion_coeff, new_camera_matrix - camera calibration, for POINT_UNDISTORT
+#                input: clock - returns the current time in ms on the MIDI clock
+def resolve_chord(chord, tracker, M, key_index, camera_matrix, distortion_coeff, new_camera_matrix, writer, metrics,
+                  clock, prefix=''):
+    for timestamp, key in chord:
+        positions = tracker.positions_at(timestamp)
+        if POINT_UNDISTORT:
+            finger_points = raw_fingers_transform(M, positions, camera_matrix, distortion_coeff, new_camera_matrix)
+        else:
+            finger_points = fingers_transform(M, positions)
+        finger = key_index.finger_on(key, finger_points)
 
-    file = open("output.txt", "w")
-    file.writelines(output)
-    file.close()
-
-
-def take_reference_image(output_location):
-    cap = cv2.VideoCapture(0)  # Open the first camera connected to the computer.
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
-    try:
-        camera_matrix = np.loadtxt('./camera_matrix.npy')
-        distortion_coeff = np.loadtxt('./distortion_coeff.npy')
-        ret, frame = cap.read()
-        h, w = frame.shape[:2]
-        new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion_coeff, (w, h), 1, (w, h))
-    except:
-        raise FileExistsError("Missing Camera Matrices and Distortion Files.")
-    original = None
-    while cv2.waitKey(1) == -1:
-        ret, frame = cap.read()
-        original = cv2.undistort(frame, camera_matrix, distortion_coeff, None, new_camera_matrix)
-        scaled_down = cv2.resize(original, (960, 540))
-        cv2.imshow("Image", scaled_down)
-    cv2.imwrite(output_location, original)
-    cv2.destroyAllWindows()
-
-
-def is_black_note(coord, black_notes, threshold):
-    return any(border[1] - threshold < coord[0] < border[1] + threshold for border in black_notes)
-
-
-def finger_transform(M, finger_point):
-    finger_point = np.array([[finger_point]], dtype=np.float32)
-    transform = cv2.perspectiveTransform(finger_point, M)
-    x_coord = int(transform[0][0][0])
-    y_coord = int(transform[0][0][1])
-    coords = np.array([x_coord, y_coord])
-    return coords
-
-
-def draw_black_keys(black, height, keyboard, black_keys):
-    for key in black_keys:
-        for x in key:
-            cv2.line(keyboard, (x, black), (x, height), (0, 255, 0), 4)
-
-
-def draw_white_keys(black, height, keyboard, t):
-    i = 0
-    for num in t:
-        if i in [0, 1, 5, 8, 12, 15, 19, 22, 26, 29]:
-            cv2.line(keyboard, (round(num), 0), (round(num), height), (0, 0, 255), 4)
+        if finger is not None:
+            print(prefix + MIDI_TO_NOTES[key], 'played with', FINGERS[finger])
+            metrics.increment('notes_played')
         else:
-            cv2.line(keyboard, (round(num), 0), (round(num), black), (0, 0, 255), 4)
-        i += 1
+            print(prefix + MIDI_TO_NOTES[key], 'MISSED')
+            metrics.increment('notes_missed')
+        metrics.observe('event_to_decision', clock() - timestamp)
+        writer.write(timestamp, key, finger, None if finger is None else finger_points[finger])
+
+
+# hand_band: The rows around the keyboard given to hand inference, in the raw frame with POINT_UNDISTORT
+#            input: margin - rows above and below the fiducial markers
+#            input: calibration - Calibration of the camera at the frame size
+def hand_band(keyboard, margin, calibration, new_camera_matrix):
+    band = (keyboard.min_y - margin, keyboard.max_y + margin)
+    if POINT_UNDISTORT:
+        band = raw_band(band, keyboard.size[0], calibration.camera_matrix, calibration.distortion_coeff,
+                        new_camera_matrix)
+    return band
+
+
+# gate_band: The rows of the raw frame between the fiducial markers, where the motion gate looks for hands
+#            input: calibration - Calibration of the camera at the frame size
+def gate_band(keyboard, calibration, new_camera_matrix):
+    return raw_band((keyboard.min_y, keyboard.max_y), keyboard.size[0], calibration.camera_matrix,
+                    calibration.distortion_coeff, new_camera_matrix)
+
+
+# find_keyboard_raw: Runs the setup phase on a raw camera frame, for recalibrating on the FiducialMonitor's thread
+def find_keyboard_raw(image, undistort_maps, parameters, warped_size):
+    return find_keyboard(apply_maps(image, undistort_maps), parameters=parameters, warped_size=warped_size)
+
+
+# station_path: Path of one of the station's files, named by a location constant such as KEYBOARD_CACHE_LOCATION
+def station_path(station, location):
+    return os.path.join(station.directory, location)
+
+
+# midi_input_id: Finds the id of a MIDI input device from its id or name, or the default input if device is None
+def midi_input_id(device):
+    from pygame import midi
+
+    if device is None:
+        return midi.get_default_input_id()
+    if isinstance(device, int):
+        return device
+    for device_id in range(midi.get_count()):
+        interface, name, is_input, is_output, opened = midi.get_device_info(device_id)
+        if is_input and name.decode() == device:
+            return device_id
+    raise Exception("Could not find MIDI input " + device)
+
+
+# take_reference_image: Shows the undistorted camera feed until a key is pressed, and returns the last raw frame
+#                       Without a window, the frame after REFERENCE_SETTLE_FRAMES frames is taken instead
+#                       input: stop - StopControl checked between frames
+#                       output: the raw frame, or None if a stop was asked for first
+def take_reference_image(cap, undistort_maps, preview, stop):
+    count = 0
+    frame = None
+    while True:
+        if stop.requested():
+            frame = None
+            break
+        ret, image = cap.read()
+        if not ret:
+            time.sleep(0.01)
+            continue
+        frame = image
+        count += 1
+        if preview.headless:
+            if count >= REFERENCE_SETTLE_FRAMES:
+                break
+        elif preview.due():
+            preview.show(apply_maps(frame, undistort_maps))
+            if preview.key_pressed():
+                break
+    preview.close()
+    return frame
 
 
 # RUN PROGRAM
-main()
+if __name__ == '__main__':
+    main()
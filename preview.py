@@ -0,0 +1,96 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# preview.py:  The preview window, shown at a throttled rate or not
+#              at all on stations without a display, and stopping the
+#              program with a signal or a control file
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import os
+import signal
+import threading
+import time
+
+import cv2
+
+
+# ignore_interrupts: Makes a worker process ignore SIGINT. Ctrl+C sends it to every process in the foreground group, and
+#                    the workers are stopped in order by the process that started them instead
+def ignore_interrupts():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Preview: Shows frames in a window at most fps times a second
+#          input: size - (width, height) the frames are shown at
+#          input: headless - never open a window, for stations without a display
+class Preview:
+    def __init__(self, window='Image', size=(960, 540), fps=10, headless=False):
+        self.window = window
+        self.size = size
+        self.interval = 1 / fps
+        self.headless = headless
+        self.shown = 0.0  # time.monotonic() when the last frame was shown
+
+    # due: Whether it is time to show another frame. Frames that are not shown should not be drawn on
+    def due(self):
+        return not self.headless and time.monotonic() - self.shown >= self.interval
+
+    # show: Shows a frame scaled down to size, with circles drawn on at points given in the frame's coordinates
+    def show(self, image, points=()):
+        self.shown = time.monotonic()
+        h, w = image.shape[:2]
+        scaled_down = cv2.resize(image, self.size)
+        for point in points:
+            if point[0] or point[1]:
+                cv2.circle(scaled_down, (int(point[0] * self.size[0] / w), int(point[1] * self.size[1] / h)), 3,
+                           (0, 0, 255), 3)
+        cv2.imshow(self.window, scaled_down)
+
+    # key_pressed: Pumps the window's events and returns whether a key was pressed, only called after show
+    def key_pressed(self):
+        return cv2.waitKey(1) != -1
+
+    def close(self):
+        if not self.headless:
+            cv2.destroyAllWindows()
+
+
+# StopControl: Asks the real time loop to stop when the process gets SIGINT or SIGTERM, or when the control file
+#              is created, such as with touch on a station without a display
+#              input: stop_file - path of the control file, None to only stop on signals
+#              input: check_interval - seconds between checks for the control file
+#              input: event - threading or multiprocessing Event to set on a stop, and to stop when set elsewhere
+class StopControl:
+    def __init__(self, stop_file=None, check_interval=0.5, event=None):
+        self.stop_file = stop_file
+        self.check_interval = check_interval
+        self.checked = 0.0
+        self.stop = threading.Event() if event is None else event
+        self.previous = {}
+
+        # A control file left over from an earlier run would stop this one straight away
+        if stop_file is not None and os.path.exists(stop_file):
+            os.remove(stop_file)
+
+    def _handle(self, signum, frame):
+        self.stop.set()
+
+    # install: Installs the signal handlers, from the main thread
+    def install(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.previous[signum] = signal.signal(signum, self._handle)
+
+    # uninstall: Puts back the signal handlers that were there before install
+    def uninstall(self):
+        for signum, handler in self.previous.items():
+            signal.signal(signum, handler)
+        self.previous = {}
+
+    # requested: Whether a stop has been asked for
+    def requested(self):
+        if self.stop.is_set():
+            return True
+        if self.stop_file is not None and time.monotonic() - self.checked >= self.check_interval:
+            self.checked = time.monotonic()
+            if os.path.exists(self.stop_file):
+                os.remove(self.stop_file)
+                self.stop.set()
+        return self.stop.is_set()
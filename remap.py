@@ -0,0 +1,78 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# remap.py:  Precomputed pixel maps for undistorting frames and
+#            for undistorting and perspective warping them in a
+#            single cv2.remap, cached to disk between runs, and
+#            the same corrections for single points
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import cv2
+import numpy as np
+
+UNDISTORT_MAPS_LOCATION = './undistort_maps.npz'
+
+
+# build_maps: Builds the fixed-point remap tables taking a raw camera frame to its undistorted image, or to the
+#             perspective warped keyboard when a homography is given
+#             input: size - (width, height) of the raw frames and of the output
+#             input: M - homography from the undistorted image to the warped keyboard, or None to only undistort
+def build_maps(camera_matrix, distortion_coeff, new_camera_matrix, size, M=None):
+    map_x, map_y = cv2.initUndistortRectifyMap(camera_matrix, distortion_coeff, None, new_camera_matrix, size,
+                                               cv2.CV_32FC1)
+    if M is not None:
+        # warpPerspective samples its input at M^-1 of every output pixel, so warping the undistort maps gives, for
+        # each warped pixel, the raw frame pixel it comes from
+        map_x = cv2.warpPerspective(map_x, M, size, borderMode=cv2.BORDER_CONSTANT, borderValue=-1)
+        map_y = cv2.warpPerspective(map_y, M, size, borderMode=cv2.BORDER_CONSTANT, borderValue=-1)
+    return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+
+# cached_maps: Loads remap tables from location if they were built from the same inputs, otherwise builds them
+#              with build_maps and saves them there for the next run
+def cached_maps(location, camera_matrix, distortion_coeff, new_camera_matrix, size, M=None):
+    inputs = {
+        'camera_matrix': camera_matrix,
+        'distortion_coeff': distortion_coeff,
+        'new_camera_matrix': new_camera_matrix,
+        'size': np.array(size),
+        'M': np.zeros((0, 0)) if M is None else M,
+    }
+    try:
+        with np.load(location) as cache:
+            if all(name in cache and cache[name].shape == np.shape(value) and np.allclose(cache[name], value)
+                   for name, value in inputs.items()):
+                return cache['map1'], cache['map2']
+    except (OSError, ValueError):
+        pass
+
+    map1, map2 = build_maps(camera_matrix, distortion_coeff, new_camera_matrix, size, M)
+    np.savez(location, map1=map1, map2=map2, **inputs)
+    return map1, map2
+
+
+# apply_maps: Remaps a raw camera frame with tables from build_maps or cached_maps
+#             input: dst - array to write the result into, or None for a new one
+def apply_maps(img, maps, dst=None):
+    return cv2.remap(img, maps[0], maps[1], cv2.INTER_LINEAR, dst=dst)
+
+
+# distort_points: Finds the raw camera frame pixels that points of the undistorted image come from
+#                 input: points - (n, 2) points in the undistorted image
+#                 output: (n, 2) float array of points in the raw frame
+def distort_points(points, camera_matrix, distortion_coeff, new_camera_matrix):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+    normalised = cv2.perspectiveTransform(points, np.linalg.inv(new_camera_matrix))
+    raw, _ = cv2.projectPoints(cv2.convertPointsToHomogeneous(normalised), np.zeros(3), np.zeros(3), camera_matrix,
+                               distortion_coeff)
+    return raw.reshape(-1, 2)
+
+
+# raw_band: The rows of the raw frame covering a band of rows of the undistorted image, which bends with the lens
+#           distortion
+#           input: band - (top, bottom) rows of the undistorted image
+#           input: width - width of the frames
+#           output: (top, bottom) rows of the raw frame
+def raw_band(band, width, camera_matrix, distortion_coeff, new_camera_matrix, samples=17):
+    xs = np.linspace(0, width - 1, samples)
+    points = [(x, y) for y in band for x in xs]
+    raw = distort_points(points, camera_matrix, distortion_coeff, new_camera_matrix)
+    return int(np.floor(raw[:samples, 1].min())), int(np.ceil(raw[samples:, 1].max()))
@@ -0,0 +1,104 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# session.py:  Recording a practice session - the camera stream,
+#              the timestamped MIDI events and the calibration -
+#              into a folder that can be processed offline later
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from keyboard import load_keyboard, save_keyboard
+
+VIDEO_NAME = 'video.avi'
+DATA_NAME = 'session.npz'
+KEYBOARD_NAME = 'keyboard.npz'
+
+
+# SessionRecorder: Writes frames to an MJPG video on a background thread and collects the MIDI events
+#                  MJPG is intra-frame only, so offline processing can seek straight to the frames it needs
+#                  input: directory - session folder, created if needed
+#                  input: size - (width, height) of the raw camera frames
+#                  input: camera_matrix, distortion_coeff - camera calibration the session was recorded with
+#                  input: keyboard - Keyboard model at the start of the session
+#                  input: backlog - most frames waiting to be written, beyond which frames are dropped and counted in
+#                                   dropped. Each raw 1080p frame holds about 6 MB
+class SessionRecorder:
+    def __init__(self, directory, size, camera_matrix, distortion_coeff, keyboard, fps=30, backlog=30):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.camera_matrix = camera_matrix
+        self.distortion_coeff = distortion_coeff
+        save_keyboard(keyboard, os.path.join(directory, KEYBOARD_NAME))
+
+        self.writer = cv2.VideoWriter(os.path.join(directory, VIDEO_NAME), cv2.VideoWriter_fourcc(*'MJPG'), fps,
+                                      tuple(size))
+        self.frame_timestamps = []  # timestamp of every frame in the video, in order
+        self.events = []  # (timestamp, status, data1, data2, data3) of every MIDI event
+        self.dropped = 0  # frames not recorded because the writer fell behind
+        self.frames = queue.Queue(maxsize=backlog)
+        self.thread = threading.Thread(target=self._run, name='SessionRecorder', daemon=True)
+        self.thread.start()
+
+    # put: Queues a captured Frame to be written, called from the capture thread
+    def put(self, frame):
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    # add_events: Records events as returned by pygame's midi.Input.read
+    def add_events(self, events):
+        self.events += [(timestamp, *data) for data, timestamp in events]
+
+    def _run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            self.writer.write(frame.image)
+            self.frame_timestamps.append(frame.timestamp)
+
+    # close: Finishes writing the video and saves the timestamps, events and calibration
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        self.writer.release()
+        np.savez(os.path.join(self.directory, DATA_NAME),
+                 frame_timestamps=np.array(self.frame_timestamps, dtype=np.int64),
+                 events=np.array(self.events, dtype=np.int64).reshape(-1, 5),
+                 camera_matrix=self.camera_matrix, distortion_coeff=self.distortion_coeff)
+        if self.dropped:
+            print('Session recording dropped', self.dropped, 'frames')
+
+
+# Session: A recorded session loaded back from its folder
+class Session:
+    def __init__(self, directory):
+        self.directory = directory
+        self.video = os.path.join(directory, VIDEO_NAME)
+        with np.load(os.path.join(directory, DATA_NAME)) as data:
+            self.frame_timestamps = data['frame_timestamps']
+            self.events = data['events']
+            self.camera_matrix = data['camera_matrix']
+            self.distortion_coeff = data['distortion_coeff']
+        self.keyboard = load_keyboard(os.path.join(directory, KEYBOARD_NAME))
+        if self.keyboard is None:
+            raise FileNotFoundError("Missing or outdated keyboard model in session " + directory)
+
+    # midi_events: Returns the events in the form pygame's midi.Input.read returns them
+    def midi_events(self):
+        return [[list(event[1:]), event[0]] for event in self.events.tolist()]
+
+    # nearest_frames: Returns the index of the frame captured closest in time to each timestamp
+    def nearest_frames(self, timestamps):
+        timestamps = np.asarray(timestamps)
+        if len(self.frame_timestamps) < 2:
+            return np.zeros(len(timestamps), dtype=int)
+        after = np.clip(np.searchsorted(self.frame_timestamps, timestamps), 1, len(self.frame_timestamps) - 1)
+        before = after - 1
+        closer_before = timestamps - self.frame_timestamps[before] <= self.frame_timestamps[after] - timestamps
+        return np.where(closer_before, before, after)
@@ -0,0 +1,137 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# supervisor.py:  Runs several camera and MIDI keyboard stations at
+#                 once, each in its own process pinned to its own
+#                 cores, merging their decisions into one output file
+#
+#                 Usage: python supervisor.py stations.json [--output stations.jsonl]
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from output_writer import FingeringWriter
+from piano import STOP_FILE, Station, run
+from preview import StopControl
+
+MERGED_OUTPUT_LOCATION = 'stations.jsonl'  # decisions of every station, in any of the FingeringWriter formats
+MAX_INFERENCE_WORKERS = 2  # most hand inference processes per station, however many cores it has
+JOIN_TIMEOUT = 10  # seconds a station is given to shut down before it is terminated
+
+
+# load_stations: Reads a JSON list of stations, each an object with the fields of piano.Station, such as
+#                [{"camera": 0, "midi_device": "Keystation 49", "calibration": "cam0.npz", "directory": "station0"}]
+#                Stations without a name are named station0, station1, ...
+def load_stations(location):
+    with open(location) as file:
+        entries = json.load(file)
+    stations = []
+    for i, entry in enumerate(entries):
+        entry.setdefault('name', 'station%d' % i)
+        if entry.get('cores') is not None:
+            entry['cores'] = tuple(entry['cores'])
+        stations.append(Station(**entry))
+    return stations
+
+
+# assign_cores: Splits the cores this process may run on evenly between the stations without cores of their own, and
+#               bounds each station's hand inference workers by its cores, keeping one for capture and lookup
+def assign_cores(stations):
+    if not hasattr(os, 'sched_getaffinity'):
+        return stations
+    unassigned = [i for i, station in enumerate(stations) if station.cores is None]
+    taken = set(core for station in stations if station.cores is not None for core in station.cores)
+    free = sorted(os.sched_getaffinity(0) - taken)
+    per_station = len(free) // len(unassigned) if unassigned else 0
+
+    stations = list(stations)
+    for n, i in enumerate(unassigned):
+        if per_station > 0:
+            stations[i] = stations[i]._replace(cores=tuple(free[n * per_station:(n + 1) * per_station]))
+    for i, station in enumerate(stations):
+        cores = len(station.cores) if station.cores is not None else 1
+        workers = max(1, min(station.inference_workers, cores - 1, MAX_INFERENCE_WORKERS))
+        stations[i] = station._replace(inference_workers=workers)
+    return stations
+
+
+# Supervisor: Starts a process running piano.run for every station and writes the decisions they send back to one file
+#             input: stations - list of piano.Station, each with its own name and directory
+#             input: output - file the decisions are merged into, each tagged with the station's name
+#             input: stop_file - control file that stops every station when created
+class Supervisor:
+    def __init__(self, stations, output=MERGED_OUTPUT_LOCATION, stop_file=STOP_FILE):
+        names = [station.name for station in stations]
+        if None in names or len(set(names)) != len(names):
+            raise ValueError("Every station needs its own name")
+        directories = [os.path.abspath(station.directory) for station in stations]
+        if len(set(directories)) != len(directories):
+            raise ValueError("Every station needs its own directory")
+
+        context = multiprocessing.get_context('spawn')
+        self.stations = assign_cores(stations)
+        self.decisions = context.Queue()
+        self.stop_event = context.Event()
+        self.stop_control = StopControl(stop_file, event=self.stop_event)
+        self.writer = FingeringWriter(output, stations=names)
+        # Not daemonic, as stations start processes of their own for hand inference and tuning. stop joins them
+        self.processes = [context.Process(target=run, args=(station, self.decisions, self.stop_event),
+                                          name=station.name) for station in self.stations]
+        self.thread = threading.Thread(target=self._merge, name='Supervisor', daemon=True)
+
+    def _merge(self):
+        while True:
+            decision = self.decisions.get()
+            if decision is None:
+                break
+            station, timestamp, key, finger, x, y = decision
+            self.writer.write(timestamp, key, finger, (x, y), station)
+
+    def start(self):
+        self.thread.start()
+        for process, station in zip(self.processes, self.stations):
+            process.start()
+            print('Started', station.name, 'on cores', station.cores, 'with', station.inference_workers,
+                  'inference workers')
+
+    # run: Starts the stations and waits until a stop is asked for or every station has exited, then stops them
+    def run(self):
+        self.stop_control.install()
+        self.start()
+        try:
+            while not self.stop_control.requested() and any(process.is_alive() for process in self.processes):
+                time.sleep(0.2)
+        finally:
+            self.stop()
+            self.stop_control.uninstall()
+
+    def stop(self):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            if process.exitcode:
+                print(process.name, 'exited with code', process.exitcode)
+        self.decisions.put(None)
+        self.thread.join()
+        self.writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several camera and MIDI keyboard stations at once')
+    parser.add_argument('stations', help='JSON file listing the stations')
+    parser.add_argument('--output', default=MERGED_OUTPUT_LOCATION, help='file the decisions are merged into')
+    args = parser.parse_args()
+
+    supervisor = Supervisor(load_stations(args.stations), args.output)
+    supervisor.run()
+    print('Wrote', supervisor.writer.count, 'decisions to', args.output)
+
+
+if __name__ == '__main__':
+    main()
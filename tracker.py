@@ -0,0 +1,114 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+# tracker.py:  Tracks the 10 fingertips between hand inferences with
+#              constant velocity Kalman filters, so the fingertips
+#              can be read at the timestamp of any MIDI event
+# - - - - - - - - - - - - - - - - - - - - - - - - -
+
+from collections import deque
+
+import numpy as np
+
+FINGER_COUNT = 10
+
+# Constant velocity model over the state [x, y, vx, vy], with positions in pixels and time in ms
+H = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], dtype=float)
+
+
+# FingertipTracker: One Kalman filter per fingertip, fed by periodic hand inference, and a short history of the
+#                   filtered states to interpolate between
+#                   input: acceleration - standard deviation of the fingertip acceleration, in pixels per ms^2
+#                   input: measurement_noise - standard deviation of the landmark positions, in pixels
+#                   input: gate - distance in pixels from the prediction beyond which a measurement restarts the
+#                                 filter instead of updating it, such as when the hands are mixed up
+#                   input: lost_after - ms without a measurement after which a fingertip is no longer tracked
+#                   input: max_extrapolation - furthest in ms a fingertip is extrapolated past its last state
+#                   input: history - number of filtered states kept
+class FingertipTracker:
+    def __init__(self, acceleration=0.005, measurement_noise=4, gate=150, lost_after=300, max_extrapolation=100,
+                 history=64):
+        self.acceleration = acceleration
+        self.measurement_noise = measurement_noise
+        self.gate = gate
+        self.lost_after = lost_after
+        self.max_extrapolation = max_extrapolation
+
+        self.x = np.zeros((FINGER_COUNT, 4))
+        self.P = np.tile(np.eye(4), (FINGER_COUNT, 1, 1))
+        self.seen = np.full(FINGER_COUNT, -np.inf)  # timestamp of the last measurement of each fingertip
+        self.timestamp = None  # timestamp of the current state
+        self.states = deque(maxlen=history)  # (timestamp, positions, velocities, tracked)
+
+    # updated_at: Timestamp of the last inference the tracker was given, or None
+    @property
+    def updated_at(self):
+        return self.timestamp
+
+    def _predict(self, dt):
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        q = self.acceleration ** 2
+        Q = np.zeros((4, 4))
+        Q[0, 0] = Q[1, 1] = q * dt ** 4 / 4
+        Q[0, 2] = Q[2, 0] = Q[1, 3] = Q[3, 1] = q * dt ** 3 / 2
+        Q[2, 2] = Q[3, 3] = q * dt ** 2
+        self.x = self.x @ F.T
+        self.P = F @ self.P @ F.T + Q
+
+    # update: Adds the fingertips found by one inference
+    #               input: timestamp - capture timestamp of the frame, on the MIDI clock
+    #               input: fingers - (10, 2) fingertips from fingers_find, [0, 0] where the hand was not found
+    def update(self, timestamp, fingers):
+        fingers = np.asarray(fingers, dtype=float).reshape(FINGER_COUNT, 2)
+        if self.timestamp is not None:
+            if timestamp <= self.timestamp:
+                return
+            self._predict(timestamp - self.timestamp)
+        self.timestamp = timestamp
+
+        found = fingers.any(axis=1)
+        tracked = timestamp - self.seen <= self.lost_after
+        innovation = fingers - self.x[:, :2]
+        restart = found & (~tracked | (np.hypot(innovation[:, 0], innovation[:, 1]) > self.gate))
+        correct = found & ~restart
+
+        # Fingertips seen for the first time in a while start at rest where they were found
+        self.x[restart] = np.hstack([fingers[restart], np.zeros((restart.sum(), 2))])
+        self.P[restart] = np.diag([self.measurement_noise ** 2] * 2 + [1.0] * 2)
+
+        if correct.any():
+            P = self.P[correct]
+            S = H @ P @ H.T + np.eye(2) * self.measurement_noise ** 2
+            K = P @ H.T @ np.linalg.inv(S)
+            self.x[correct] += (K @ innovation[correct][:, :, None])[:, :, 0]
+            self.P[correct] = (np.eye(4) - K @ H) @ P
+
+        self.seen[found] = timestamp
+        tracked = timestamp - self.seen <= self.lost_after
+        self.states.append((timestamp, self.x[:, :2].copy(), self.x[:, 2:].copy(), tracked))
+
+    # positions_at: Estimates every fingertip at a timestamp, interpolating between the filtered states around it or
+    #               extrapolating from the last one
+    #               output: (10, 2) integer array, [0, 0] for fingertips that are not tracked, like fingers_find
+    def positions_at(self, timestamp):
+        if not self.states:
+            return np.zeros((FINGER_COUNT, 2), dtype=int)
+
+        times = [state[0] for state in self.states]
+        after = np.searchsorted(times, timestamp)
+        if after == 0:
+            t0, positions, velocities, tracked = self.states[0]
+            points = positions
+        elif after == len(times):
+            t0, positions, velocities, tracked = self.states[-1]
+            points = positions + velocities * min(timestamp - t0, self.max_extrapolation)
+        else:
+            # Cubic Hermite interpolation using the filtered velocities as tangents
+            t0, p0, v0, tracked0 = self.states[after - 1]
+            t1, p1, v1, tracked1 = self.states[after]
+            dt = t1 - t0
+            s = (timestamp - t0) / dt
+            points = ((2 * s ** 3 - 3 * s ** 2 + 1) * p0 + (s ** 3 - 2 * s ** 2 + s) * dt * v0
+                      + (-2 * s ** 3 + 3 * s ** 2) * p1 + (s ** 3 - s ** 2) * dt * v1)
+            tracked = tracked0 & tracked1
+        points = np.where(tracked[:, None], np.round(points), 0)
+        return points.astype(int)